@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Benchmark connecting a tunnel over a slow link, by bootstrap mode.
+
+The link is simulated by a relay process that delays and rate-limits the
+data sent from the controller to the remote Python process.
+
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+
+from chopsticks.tunnel import Local
+
+
+# Relay stdin to a child process, rate-limited to RATE bytes/s, with each
+# chunk delayed by DELAY seconds
+THROTTLE = '''
+import os, sys, time, subprocess
+rate, delay = float(sys.argv[1]), float(sys.argv[2])
+child = subprocess.Popen(sys.argv[3:], stdin=subprocess.PIPE, bufsize=0)
+free = 0
+while True:
+    chunk = os.read(0, 1024)
+    if not chunk:
+        break
+    now = time.time()
+    free = max(free, now + delay) + len(chunk) / rate
+    time.sleep(max(0, free - now))
+    child.stdin.write(chunk)
+child.stdin.close()
+sys.exit(child.wait())
+'''
+
+
+class Throttled(Local):
+    """A local tunnel whose input arrives over a slow link."""
+
+    rate = 8192
+    delay = 0.05
+
+    def cmd_args(self):
+        return [
+            sys.executable, '-c', THROTTLE, str(self.rate), str(self.delay)
+        ] + super(Throttled, self).cmd_args()
+
+
+MODES = [
+    ('uncompressed', False, False),
+    ('zlib', True, False),
+    ('zlib, minified', True, True),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--rate', type=float, default=8192,
+        help='Link bandwidth in bytes/s (default 8192)'
+    )
+    parser.add_argument(
+        '--delay', type=float, default=0.05,
+        help='One-way latency in seconds (default 0.05)'
+    )
+    parser.add_argument(
+        '-n', type=int, default=5,
+        help='Connections to time per mode (default 5)'
+    )
+    args = parser.parse_args()
+
+    for name, compress, minify in MODES:
+        times = []
+        for _ in range(args.n):
+            tun = Throttled()
+            tun.rate = args.rate
+            tun.delay = args.delay
+            tun.compress_bubble = compress
+            tun.minify_bubble = minify
+            size = len(tun._bootstrap()[0])
+            start = time.time()
+            tun.connect()
+            times.append(time.time() - start)
+            tun.close()
+        print('%-16s %6d bytes  connect %.3fs (min %.3fs)' % (
+            name, size, sum(times) / len(times), min(times)
+        ))
+
+
+if __name__ == '__main__':
+    main()
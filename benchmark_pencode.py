@@ -2,7 +2,9 @@
 
 import perf
 
-from chopsticks.pencode import pencode, pdecode
+from chopsticks.pencode import (
+    pencode, pencode_into, pdecode, HIGHEST_PROTOCOL
+)
 
 
 def setup():
@@ -30,15 +32,34 @@ def setup():
          'r': 114, 'u': 117, 't': 116, 'w': 119, 'y': 121, 'x': i},
     ] for i in range(1000)]
 
+
+def setup_metrics():
+    return [[float(j) * i for j in range(100)] for i in range(1000)]
+
 runner = perf.Runner()
 
 
 if __name__ == '__main__':
-    v = setup()
-    assert pdecode(pencode(v)) == v
-    #pencode(v)
-    runner.timeit(
-        name='pencode',
-        stmt='pencode(v)',
-        globals={'v': v, 'pencode': pencode},
-    )
+    payloads = [('', setup()), (' metrics', setup_metrics())]
+    for suffix, v in payloads:
+        for protocol in range(1, HIGHEST_PROTOCOL + 1):
+            buf = pencode(v, protocol)
+            assert pdecode(buf) == v
+            runner.timeit(
+                name='pencode v%d%s' % (protocol, suffix),
+                stmt='pencode(v, protocol)',
+                globals={'v': v, 'pencode': pencode, 'protocol': protocol},
+            )
+            runner.timeit(
+                name='pencode_into v%d%s' % (protocol, suffix),
+                stmt='pencode_into(v, bytearray(), protocol)',
+                globals={
+                    'v': v, 'pencode_into': pencode_into,
+                    'protocol': protocol
+                },
+            )
+            runner.timeit(
+                name='pdecode v%d%s' % (protocol, suffix),
+                stmt='pdecode(buf)',
+                globals={'buf': buf, 'pdecode': pdecode},
+            )
@@ -0,0 +1,366 @@
+"""Support for driving tunnels from an asyncio event loop.
+
+This module requires Python 3.5 or later. It is not normally used directly;
+instead, await the coroutine methods of tunnels and groups, such as
+:meth:`.BaseTunnel.acall()` and :meth:`.Group.acall()`.
+
+A tunnel connected from a coroutine has its pipes attached to the running
+event loop with ``connect_read_pipe()`` and ``connect_write_pipe()``, so any
+number of tunnels can be driven from the application's own thread.
+
+"""
+import asyncio
+import subprocess
+from collections import deque
+
+from .ioloop import MessageDecoder, MessageWriter
+from .tunnel import (
+    loop, ErrorResult, RemoteException, deadline_for, remaining,
+    prepare_call
+)
+from .group import GroupResult
+
+
+class PipeReader(MessageDecoder, asyncio.Protocol):
+    """Decode messages received from a read pipe transport."""
+
+    def __init__(self, tunnel):
+        super().__init__(tunnel)
+        self.transport = None
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.feed(data)
+
+    def connection_lost(self, exc):
+        if self.closed:
+            return
+        self.running = False
+        if exc:
+            self.errback('Error reading stream: %s' % exc)
+        else:
+            self.errback('Unexpected EOF on stream')
+
+    def start(self):
+        self.running = True
+        self.transport.resume_reading()
+        # Dispatch anything that arrived while we were stopped
+        self._check()
+
+    def stop(self):
+        self.running = False
+        if self.transport:
+            self.transport.pause_reading()
+
+    def close(self):
+        self.closed = True
+        self.running = False
+        self.transport.close()
+
+
+class PipeWriter(asyncio.Protocol):
+    """Write framed messages to a write pipe transport.
+
+    Messages from iterables passed to :meth:`write_iter` are only taken as
+    the transport's buffer drains.
+
+    """
+    _encode = MessageWriter._encode
+    pencode_protocol = MessageWriter.pencode_protocol
+
+    def __init__(self):
+        self.transport = None
+        self.paused = False
+        self.iters = deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.iters.clear()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._pump()
+
+    def write(self, op, req_id, data):
+        for buf in self._encode(op, req_id, data):
+            self.transport.write(buf)
+
+    def write_raw(self, bytes):
+        """Write a byte string to the pipe."""
+        if bytes:
+            self.transport.write(bytes)
+
+    def write_iter(self, iterable):
+        """Write messages from an iterable to the pipe."""
+        self.iters.append(iter(iterable))
+        self._pump()
+
+    def _pump(self):
+        """Write messages from queued iterables until the buffer fills."""
+        iters = self.iters
+        while iters and not self.paused:
+            try:
+                msg = next(iters[0])
+            except StopIteration:
+                iters.popleft()
+                continue
+            self.write(*msg)
+
+    def stop(self):
+        self.iters.clear()
+        self.transport.abort()
+
+
+def _raise_for(result):
+    """Raise RemoteException if result is an ErrorResult."""
+    if isinstance(result, ErrorResult):
+        raise RemoteException(result.msg)
+    return result
+
+
+def _result_future(aloop):
+    """Return a future, and a callback that sets its result."""
+    future = aloop.create_future()
+
+    def on_result(result):
+        # The waiting task may have been cancelled
+        if not future.done():
+            future.set_result(result)
+    return future, on_result
+
+
+def _wait(proc, timeout):
+    """Wait for a process to exit, returning False if it does not."""
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False
+    return True
+
+
+async def _reap(tunnel, proc):
+    """Wait for a disconnected tunnel's process to exit.
+
+    As in :meth:`.PipeTunnel.close`, the process is terminated if it has not
+    exited after a second, and killed if it has not 5 seconds after that.
+    The waiting happens in an executor thread.
+
+    """
+    aloop = asyncio.get_event_loop()
+    if await aloop.run_in_executor(None, _wait, proc, 1):
+        return
+    proc.terminate()
+    if await aloop.run_in_executor(None, _wait, proc, 5):
+        return
+    proc.kill()
+    tunnel._warn('Timeout expired waiting for pipe to close')
+
+
+def close_nowait(tunnel):
+    """Disconnect a tunnel, reaping its process in a task on its loop."""
+    aloop = tunnel.loop
+    proc = tunnel.proc
+    tunnel._disconnect()
+    if not aloop.is_closed():
+        aloop.create_task(_reap(tunnel, proc))
+
+
+async def close(tunnel):
+    """Disconnect the tunnel and wait for its process to exit."""
+    aloop = asyncio.get_event_loop()
+    if tunnel.loop is not aloop:
+        # Not connected on this loop; close() does not need to block it
+        await aloop.run_in_executor(None, tunnel.close)
+        return
+    proc = tunnel.proc
+    tunnel._disconnect()
+    await _reap(tunnel, proc)
+
+
+async def _connect(tunnel, timeout=None):
+    """Connect the tunnel on the running event loop.
+
+    Return None, or an ErrorResult if the connection failed.
+
+    """
+    if tunnel.connected:
+        return None
+    aloop = asyncio.get_event_loop()
+    future, on_result = _result_future(aloop)
+    if tunnel.connecting is not None:
+        if tunnel.loop is not aloop:
+            raise RuntimeError(
+                '%r is being connected on a different loop' % tunnel
+            )
+        tunnel.connecting.append(on_result)
+        return await future
+
+    path = tunnel._connect_path()
+    tunnel.connecting = [on_result]
+    try:
+        tunnel.connect_pipes()
+        reader = PipeReader(tunnel)
+        writer = PipeWriter()
+        await aloop.connect_read_pipe(lambda: reader, tunnel.rpipe)
+        await aloop.connect_write_pipe(lambda: writer, tunnel.wpipe)
+    except Exception as e:
+        # Fail any other coroutines waiting on this connection
+        callbacks = tunnel.connecting[1:]
+        tunnel.connecting = None
+        for cb in callbacks:
+            cb(ErrorResult('Failed to connect: %s' % e))
+        raise
+    tunnel.loop = aloop
+    tunnel.reader = reader
+    tunnel.writer = writer
+    tunnel._handshake(path, timeout)
+    return await future
+
+
+async def connect(tunnel, timeout=None):
+    """Connect the tunnel on the running event loop."""
+    _raise_for(await _connect(tunnel, timeout))
+
+
+def _start(tunnel, method, *args, **kwargs):
+    """Start an operation on the tunnel and return a future for its result.
+
+    `method` is the name of one of the tunnel's asynchronous methods. If the
+    tunnel was connected synchronously, and the Chopsticks IOLoop is
+    running in a background thread, the operation is started there.
+
+    """
+    aloop = asyncio.get_event_loop()
+    future, on_result = _result_future(aloop)
+    func = getattr(tunnel, method)
+    if tunnel.loop is aloop:
+        func(on_result, *args, **kwargs)
+    elif tunnel.loop is loop and loop.in_other_thread():
+        def callback(result):
+            aloop.call_soon_threadsafe(on_result, result)
+        loop.call_soon_threadsafe(
+            lambda: func(callback, *args, **kwargs)
+        )
+    else:
+        raise RuntimeError(
+            '%r is connected to a different event loop' % tunnel
+        )
+    return future
+
+
+async def _prepare_call(tunnels, callable, args, kwargs):
+    """Prepare a call in an executor, as finding its imports is slow."""
+    aloop = asyncio.get_event_loop()
+    return await aloop.run_in_executor(
+        None, prepare_call, tunnels, callable, args, kwargs
+    )
+
+
+async def call(tunnel, callable, *args, **kwargs):
+    """Call the callable on the remote host."""
+    deadline = deadline_for(kwargs.pop('timeout', None))
+    await connect(tunnel, timeout=remaining(deadline))
+    call = await _prepare_call([tunnel], callable, args, kwargs)
+    return _raise_for(await _start(
+        tunnel, '_call_async', *call, timeout=remaining(deadline)
+    ))
+
+
+async def fetch(tunnel, remote_path, local_path=None, timeout=None):
+    """Fetch one file from the remote host."""
+    deadline = deadline_for(timeout)
+    await connect(tunnel, timeout=remaining(deadline))
+    return _raise_for(await _start(
+        tunnel, '_fetch_async', remote_path, local_path,
+        timeout=remaining(deadline)
+    ))
+
+
+async def put(tunnel, local_path, remote_path=None, mode=0o644, timeout=None):
+    """Copy a file to the remote host."""
+    deadline = deadline_for(timeout)
+    await connect(tunnel, timeout=remaining(deadline))
+    return _raise_for(await _start(
+        tunnel, '_put_async', local_path, remote_path, mode,
+        timeout=remaining(deadline)
+    ))
+
+
+async def group_op(group, jobs, method, kwargs, timeout, max_parallel):
+    """Run an operation on many tunnels at once.
+
+    `jobs` is a list of (tunnel, args) pairs. Each tunnel is connected if
+    necessary and then `method` is called on it with args and kwargs. If
+    `method` is None, tunnels are only connected.
+
+    If `max_parallel` is given, at most this many tunnels are in flight at
+    once, and `timeout` applies to each tunnel from the time it starts.
+
+    Return a :class:`GroupResult`.
+
+    """
+    results = GroupResult(group.connection_errors)
+    if max_parallel:
+        limit = asyncio.Semaphore(max_parallel)
+        group_deadline = None
+    else:
+        limit = None
+        group_deadline = deadline_for(timeout)
+
+    async def run(tunnel, args):
+        if limit is None:
+            deadline = group_deadline
+        else:
+            deadline = deadline_for(timeout)
+        err = await _connect(tunnel, timeout=remaining(deadline))
+        if isinstance(err, ErrorResult):
+            group.connection_errors[tunnel.host] = err
+            results[tunnel.host] = err
+            return
+        group.connection_errors.pop(tunnel.host, None)
+        if method is None:
+            results.pop(tunnel.host, None)
+            return
+        results[tunnel.host] = await _start(
+            tunnel, method, *args,
+            timeout=remaining(deadline), **kwargs
+        )
+
+    async def run_limited(tunnel, args):
+        async with limit:
+            await run(tunnel, args)
+
+    runner = run if limit is None else run_limited
+    await asyncio.gather(*[runner(t, args) for t, args in jobs])
+    return results
+
+
+async def group_call(group, callable, args, kwargs, timeout, max_parallel):
+    """Call the callable on all hosts in the group."""
+    tunnels = group._usable_tunnels()
+    call = await _prepare_call(tunnels, callable, args, kwargs)
+    return await group_op(
+        group, [(t, call) for t in tunnels], '_call_async', {},
+        timeout, max_parallel
+    )
+
+
+async def group_close(group):
+    """Close all tunnels in the group."""
+    await asyncio.gather(*[close(t) for t in group.tunnels])
+
+
+async def group_connect(group, timeout=None, max_parallel=None):
+    """Connect all tunnels in the group."""
+    await group_op(
+        group, [(t, ()) for t in group.tunnels],
+        None, {}, timeout, max_parallel
+    )
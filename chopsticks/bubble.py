@@ -23,7 +23,7 @@ PY3 = not PY2
 import threading
 if PY2:
     __metaclass__ = type
-    from Queue import Queue
+    from Queue import Queue, Empty
     import cPickle as pickle
 
     def exec_(_code_, _globs_=None, _locs_=None):
@@ -39,7 +39,7 @@ if PY2:
         exec("""exec _code_ in _globs_, _locs_""")
     range = xrange
 else:
-    from queue import Queue
+    from queue import Queue, Empty
     import pickle
     exec_ = getattr(__builtins__, 'exec')
 from imp import is_builtin
@@ -53,18 +53,135 @@ import traceback
 from base64 import b64decode
 import tempfile
 import codecs
+import marshal
 
 
-outqueue = Queue(maxsize=10)
-tasks = Queue()
+outqueue = Queue(maxsize=64)
 done = object()
 
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# Stop gathering queued messages for one write once we have this many bytes
+WRITE_SIZE = 256 * 1024
+
 running = True
 
-Imp = namedtuple('Imp', 'exists is_pkg file source')
+Imp = namedtuple('Imp', 'exists is_pkg file source sha1')
+# The response for modules that the controller does not have
+MISSING = Imp(False, False, None, '', None)
 PREFIX = 'chopsticks://'
 
 
+class ModuleCache:
+    """Module sources and bytecode kept on disk between sessions.
+
+    Files are named by the SHA-1 hash of the module source. Entries that
+    have not been used for MAX_AGE are removed when the cache is opened.
+
+    """
+    MAX_AGE = 30 * 24 * 3600  # seconds
+
+    def __init__(self, path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            pass
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            # Others could plant code for us to run
+            raise IOError('Module cache %s is not private' % path)
+        self.path = path
+        self.magic = codecs.encode(imp.get_magic(), 'hex').decode('ascii')
+
+    def _path(self, digest, ext):
+        return os.path.join(self.path, digest + ext)
+
+    def digests(self):
+        """List the hashes of the sources in the cache, pruning old ones."""
+        digests = []
+        expire = time.time() - self.MAX_AGE
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime < expire:
+                    os.unlink(path)
+                    continue
+            except OSError:
+                continue
+            digest, _, ext = name.partition('.')
+            if ext == 'py' and len(digest) == 40:
+                digests.append(digest)
+        return digests
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def _write(self, path, data):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def load_source(self, digest):
+        """Get the source with the given hash, or None."""
+        return self._read(self._path(digest, '.py'))
+
+    def save_source(self, digest, source):
+        self._write(self._path(digest, '.py'), source)
+
+    def compile(self, m, filename):
+        """Get the code object for the module m, compiling it if needed."""
+        path = self._path(m.sha1, '.%s.pyc' % self.magic)
+        data = self._read(path)
+        if data is not None:
+            try:
+                code = marshal.loads(data)
+            except Exception:
+                code = None
+            # Identical sources may be cached for differently named modules
+            if code is not None and code.co_filename == filename:
+                return code
+        code = compile(m.source, filename, 'exec', dont_inherit=True)
+        self._write(path, marshal.dumps(code))
+        return code
+
+    def resolve(self, imps):
+        """Fill in cached sources for received (mod, Imp) pairs.
+
+        Store any new sources. Modules whose cached source cannot be read
+        are requested again, and left out of the result.
+
+        """
+        resolved = []
+        for mod, m in imps:
+            if m.sha1:
+                if m.source is None:
+                    source = self.load_source(m.sha1)
+                    if source is None:
+                        send_msg(OP_IMP, 0, {'imp': mod})
+                        continue
+                    m = m._replace(source=source)
+                else:
+                    self.save_source(m.sha1, m.source)
+            resolved.append((mod, m))
+        return resolved
+
+
+modcache = None
+
+
 class Loader:
     # Imports that don't succeed after this amount of time will time out
     # This can help crash a remote process when the controller hangs, thus
@@ -81,11 +198,12 @@ class Loader:
         self.path = path
 
     @classmethod
-    def on_receive(cls, mod, imp):
+    def on_receive(cls, imps):
         with cls.lock:
-            if isinstance(mod, list):
-                mod = tuple(mod)
-            cls.cache[mod] = imp
+            for mod, imp in imps:
+                if isinstance(mod, list):
+                    mod = tuple(mod)
+                cls.cache[mod] = imp
             cls.ev.notifyAll()
 
     def _raw_get(self, fullname):
@@ -93,21 +211,18 @@ class Loader:
             if fullname in self.cache:
                 return self.cache[fullname]
             send_msg(OP_IMP, 0, {'imp': fullname})
-            start = time.time()
-            self.ev.wait(timeout=self.TIMEOUT)
-            delay = time.time() - start
-            if delay >= self.TIMEOUT:
-                raise IOError(
-                    'Timed out after %ds waiting for import %r'
-                    % (self.TIMEOUT, fullname)
-                )
-            try:
-                imp = self.cache[fullname]
-            except KeyError:
-                raise IOError(
-                    'Did not find %s in %s' % (fullname, self.cache)
-                )
-        return imp
+            # Other threads' imports, and modules sent ahead of calls, may
+            # arrive before ours
+            deadline = time.time() + self.TIMEOUT
+            while fullname not in self.cache:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError(
+                        'Timed out after %ds waiting for import %r'
+                        % (self.TIMEOUT, fullname)
+                    )
+                self.ev.wait(timeout=remaining)
+            return self.cache[fullname]
 
     def get(self, fullname):
         if isinstance(fullname, str) and is_builtin(fullname) != 0:
@@ -141,7 +256,10 @@ class Loader:
             #mod.__loader__ = Loader(modpath)
         else:
             mod.__package__ = modname.rpartition('.')[0]
-        code = compile(m.source, mod.__file__, 'exec', dont_inherit=True)
+        if modcache and m.sha1:
+            code = modcache.compile(m, mod.__file__)
+        else:
+            code = compile(m.source, mod.__file__, 'exec', dont_inherit=True)
         exec(code, mod.__dict__)
         if fullname == '__main__':
             mod.__name__ == '__main__'
@@ -175,21 +293,78 @@ def transmit_errors(func):
     return wrapper
 
 
-@transmit_errors
-def handle_call_threaded(req_id, data):
-    threading.Thread(target=handle_call_thread, args=(req_id, data)).start()
+class Pool:
+    """A bounded pool of worker threads that run calls and fetches.
+
+    Tasks are queued when all workers are busy. Import responses are handled
+    by the reader thread, never by a worker, so a worker blocked in an import
+    cannot starve the pool of the response it is waiting for.
+
+    """
+    def __init__(self):
+        self.tasks = Queue()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.idle = 0
+
+    def start(self, size):
+        """Start workers so that there are at least size of them."""
+        with self.lock:
+            new = max(0, size - self.size)
+            self.size += new
+            self.idle += new
+        for _ in range(new):
+            threading.Thread(target=self.work).start()
+
+    def submit(self, func, *args):
+        """Run func(*args, wait=...) in a worker.
+
+        `wait` is the number of seconds the task was queued because no
+        worker was free, or None if it did not have to wait.
+
+        """
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+                queued = None
+            else:
+                queued = time.time()
+        self.tasks.put((queued, func, args))
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is done:
+                # Pass it on to the other workers
+                self.tasks.put(done)
+                break
+            queued, func, args = task
+            wait = None if queued is None else time.time() - queued
+            try:
+                func(*args, wait=wait)
+            finally:
+                with self.lock:
+                    self.idle += 1
+
+    def stop(self):
+        """Stop the workers once queued tasks are complete."""
+        self.tasks.put(done)
+
+
+pool = Pool()
 
 
 @transmit_errors
-def handle_call_thread(req_id, data):
-    callable, args, kwargs = pickle.loads(data)
-    do_call(req_id, callable, args, kwargs)
+def handle_call(req_id, data):
+    pool.submit(run_call, req_id, data)
 
 
 @transmit_errors
-def handle_call_queued(req_id, data):
+def run_call(req_id, data, wait=None):
+    # Unpickle in the worker: this may import modules from the host, which
+    # needs the reader thread to be free to receive them
     callable, args, kwargs = pickle.loads(data)
-    tasks.put((req_id, callable, args, kwargs))
+    do_call(req_id, callable, args, kwargs, wait=wait)
 
 
 OP_CALL = 0
@@ -205,14 +380,11 @@ OP_PUT_END = 9
 OP_START = 10
 
 
-# FIXME: handle_call_queued seems to deadlock!
-handle_call = handle_call_threaded
-
 
 @transmit_errors
 def handle_fetch(req_id, path):
     """Fetch a file by path."""
-    tasks.put((req_id, do_fetch, (req_id, path,)))
+    pool.submit(do_call, req_id, do_fetch, (req_id, path), {})
 
 
 def do_fetch(req_id, path):
@@ -232,20 +404,33 @@ def do_fetch(req_id, path):
 
 
 @transmit_errors
-def do_call(req_id, callable, args=(), kwargs={}):
+def do_call(req_id, callable, args=(), kwargs={}, wait=None):
     ret = callable(*args, **kwargs)
-    send_msg(
-        OP_RET,
-        req_id,
-        {
-            'ret': ret,
-            # 'callable': callable.__module__ + '.' + callable.__name__
-        }
-    )
+    msg = {
+        'ret': ret,
+        # 'callable': callable.__module__ + '.' + callable.__name__
+    }
+    if wait is not None:
+        # Let the host know we are saturated
+        msg['wait'] = wait
+    send_msg(OP_RET, req_id, msg)
+
+
+def handle_imp(
+        req_id, mod=None, exists=False, is_pkg=False, file=None, source=None,
+        sha1=None, batch=(), missing=()):
+    """Receive one requested module, or a batch of modules sent unasked.
 
+    `missing` lists modules that the controller does not have.
 
-def handle_imp(req_id, mod, exists, is_pkg, file, source):
-    Loader.on_receive(mod, Imp(exists, is_pkg, file, source))
+    """
+    imps = [(m[0], Imp(*m[1:])) for m in batch]
+    if mod is not None:
+        imps.append((mod, Imp(exists, is_pkg, file, source, sha1)))
+    if modcache:
+        imps = modcache.resolve(imps)
+    imps.extend((m, MISSING) for m in missing)
+    Loader.on_receive(imps)
 
 
 active_puts = {}
@@ -330,11 +515,34 @@ def handle_end_put(req_id, sha1sum):
     )
 
 
-def handle_start(req_id, host, path, depthlimit):
+def handle_start(
+        req_id, host, path, depthlimit, workers=16, queue_depth=64,
+        missing=(), module_cache=False, pencode_protocol=1):
+    global modcache, send_protocol
     sys._chopsticks_host = force_str(host)
     sys._chopsticks_path = [force_str(p) for p in path]
     sys._chopsticks_depthlimit = depthlimit
-    send_msg(OP_RET, req_id, {'ret': pickle.HIGHEST_PROTOCOL})
+    Loader.on_receive([(m, MISSING) for m in missing])
+    with outqueue.not_full:
+        outqueue.maxsize = max(1, queue_depth)
+        outqueue.not_full.notify_all()
+    pool.start(max(1, workers))
+    send_protocol = min(HIGHEST_PROTOCOL, pencode_protocol)
+    msg = {'ret': pickle.HIGHEST_PROTOCOL, 'pencode_protocol': send_protocol}
+    if module_cache:
+        if module_cache is True:
+            base = (
+                os.environ.get('XDG_CACHE_HOME') or
+                os.path.expanduser('~/.cache')
+            )
+            module_cache = os.path.join(base, 'chopsticks', 'modules')
+        try:
+            modcache = ModuleCache(force_str(module_cache))
+            # Tell the controller which sources it need not send
+            msg['cached'] = modcache.digests()
+        except (IOError, OSError) as e:
+            debug('Not using module cache: %s' % e)
+    send_msg(OP_RET, req_id, msg)
 
 
 HEADER = struct.Struct('!LLbb')
@@ -342,6 +550,9 @@ HEADER = struct.Struct('!LLbb')
 MSG_BYTES = 1
 MSG_PENCODE = 2
 
+# The pencode protocol to send, as agreed with the controller in OP_START
+send_protocol = 1
+
 
 def send_msg(op, req_id, data):
     """Send a message to the orchestration host.
@@ -351,12 +562,14 @@ def send_msg(op, req_id, data):
 
     """
     if isinstance(data, bytes):
-        fmt = MSG_BYTES
+        msg = (HEADER.pack(len(data), req_id, op, MSG_BYTES), data)
     else:
-        fmt = MSG_PENCODE
-        data = pencode(data)
-    chunk = HEADER.pack(len(data), req_id, op, fmt) + data
-    outqueue.put(chunk)
+        # Encode into one buffer after space reserved for the header
+        frame = bytearray(HEADER.size)
+        size = pencode_into(data, frame, send_protocol)
+        HEADER.pack_into(frame, 0, size, req_id, op, MSG_PENCODE)
+        msg = (frame,)
+    outqueue.put(msg)
 
 
 def read_msg():
@@ -399,27 +612,54 @@ def reader():
             HANDLERS[op](req_id, **params)
     finally:
         outqueue.put(done)
-        tasks.put(done)
+        pool.stop()
+
+
+if hasattr(os, 'writev'):
+    def write_bufs(bufs):
+        """Write a list of buffers to the output pipe."""
+        i = 0
+        while i < len(bufs):
+            written = os.writev(outfd, bufs[i:i + IOV_MAX])
+            while written:
+                size = len(bufs[i])
+                if written < size:
+                    bufs[i] = memoryview(bufs[i])[written:]
+                    break
+                written -= size
+                i += 1
+else:
+    def write_bufs(bufs):
+        """Write a list of buffers to the output pipe."""
+        # Python 2's str.join() does not accept the bytearrays of pencoded
+        # frames
+        outpipe.write(b''.join(map(bytes, bufs)))
 
 
 def writer():
+    """Send queued messages, coalescing them into as few writes as possible."""
     while True:
         msg = outqueue.get()
+        bufs = []
+        size = 0
+        while msg is not done:
+            bufs.extend(msg)
+            size += sum(len(buf) for buf in msg)
+            if size >= WRITE_SIZE:
+                break
+            try:
+                msg = outqueue.get_nowait()
+            except Empty:
+                break
+        if bufs:
+            write_bufs(bufs)
         if msg is done:
             break
-        outpipe.write(msg)
-
 
 
 def run():
-    for func in (reader, writer):
-        threading.Thread(target=func).start()
-
-    while True:
-        task = tasks.get()
-        if task is done:
-            break
-        do_call(*task)
+    threading.Thread(target=writer).start()
+    reader()
 
 
 # The source code from chopsticks.pencode will be substituted here
@@ -7,8 +7,13 @@ used with Queues to schedule operations asynchronously on a number of hosts.
 """
 
 from operator import not_
+from collections import deque
 from .setops import SetOps
-from .tunnel import SSHTunnel, loop, PY2, ErrorResult, pickle, RemoteException
+from .tunnel import (
+    SSHTunnel, PY2, ErrorResult, pickle, RemoteException,
+    deadline_for, remaining, run_op, Waiter, prepare_call
+)
+from .prefetch import import_closure
 
 __metaclass__ = type
 
@@ -94,13 +99,20 @@ class GroupOp:
 class Group(SetOps):
     """A group of hosts, for performing operations in parallel."""
 
-    def __init__(self, hosts):
+    #: The default limit on the number of hosts to operate on at once, or
+    #: None for no limit.
+    max_parallel = None
+
+    def __init__(self, hosts, max_parallel=None):
         """Construct a group from a list of tunnels or hosts.
 
         `hosts` may contain hostnames - in which case the connections will be
         made via SSH using the default settings. Alternatively, it may contain
         tunnel instances.
 
+        If `max_parallel` is given, operations on the group will have at most
+        this many hosts in flight at once (see :ref:`rolling`).
+
         """
         self.tunnels = []
         for h in hosts:
@@ -108,28 +120,197 @@ class Group(SetOps):
                 h = SSHTunnel(h)
             self.tunnels.append(h)
         self.connection_errors = {}
+        if max_parallel is not None:
+            self.max_parallel = max_parallel
+
+    def _new_op(self, callback):
+        op = GroupOp(callback)
+        op.results = self.connection_errors.copy()
+        return op
+
+    def _run_op(self, start):
+        """Run an operation on the loop, closing all tunnels on error."""
+        for t in self.tunnels:
+            t._check_blocking()
+        try:
+            return run_op(start)
+        except:
+            self.close()
+            raise
 
-    def _new_op(self):
-        self.op = GroupOp(loop.stop)
-        self.op.results = self.connection_errors.copy()
+    def _record_connection(self, tunnel, ret):
+        """Record whether tunnel is connected, given an operation's result.
+
+        Operations connect tunnels as they start, so the result of a tunnel
+        that failed to connect is the connection error.
+
+        """
+        if tunnel.connected:
+            self.connection_errors.pop(tunnel.host, None)
+        elif isinstance(ret, ErrorResult):
+            self.connection_errors[tunnel.host] = ret
 
     def _parallel(self, tunnels, method, *args, **kwargs):
         """Helper to call a method on all tunnels."""
-        self._new_op()
-        for t in tunnels:
-            m = getattr(t, method)
-            m(self.op.make_callback(t.host), *args, **kwargs)
+        return self._parallel_jobs(
+            [(t, args) for t in tunnels], method, kwargs
+        )
+
+    def _parallel_jobs(self, jobs, method, kwargs):
+        """Call a method on each tunnel in `jobs` with different args.
+
+        `jobs` is a list of (tunnel, args) pairs.
+
+        """
+        def start(callback):
+            op = self._new_op(callback)
+            if not jobs:
+                callback(GroupResult(op.results))
+            for t, args in jobs:
+                m = getattr(t, method)
+                m(op.make_callback(t.host), *args, **kwargs)
+        result = self._run_op(start)
+        for t, args in jobs:
+            self._record_connection(t, result.get(t.host))
+        return result
+
+    def _rolling(self, jobs, method, kwargs, timeout, max_parallel):
+        """Run an operation with at most max_parallel hosts in flight.
+
+        `jobs` is a list of (tunnel, args) pairs. Each tunnel is connected if
+        necessary and then `method` is called on it with args and kwargs; as
+        soon as one host finishes the next is started. If `method` is None,
+        tunnels are only connected.
+
+        `timeout` applies to each host separately, from the time it starts.
+
+        """
+        def start_all(callback):
+            op = self._new_op(callback)
+            pending = deque(
+                (t, args, op.make_callback(t.host))
+                for t, args in jobs
+            )
+            if not pending:
+                callback(GroupResult(op.results))
+                return
+
+            def admit():
+                tunnel, args, on_result = pending.popleft()
+                deadline = deadline_for(timeout)
+
+                def done(ret):
+                    self._record_connection(tunnel, ret)
+                    on_result(ret)
+                    if pending:
+                        admit()
+
+                if method is None:
+                    tunnel._connect_async(done, timeout=remaining(deadline))
+                else:
+                    # Operations connect the tunnel themselves if necessary
+                    getattr(tunnel, method)(
+                        done, *args,
+                        timeout=remaining(deadline), **kwargs
+                    )
+
+            for _ in range(min(max_parallel, len(pending))):
+                admit()
+        return self._run_op(start_all)
+
+    def _usable_tunnels(self):
+        """Get the tunnels that have not failed to connect."""
+        return [
+            t for t in self.tunnels
+            if t.connected or t.host not in self.connection_errors
+        ]
+
+    def _iter_parallel(self, tunnels, method, *args, **kwargs):
+        """Call a method on all tunnels.
+
+        Return an iterator that yields (host, result) pairs as results
+        arrive. Connection errors for the group are yielded first.
+
+        """
+        ready = deque(self.connection_errors.items())
+        state = {'closed': False}
+        waiter = Waiter()
+
+        def make_callback(tunnel):
+            def cb(ret):
+                self._record_connection(tunnel, ret)
+                if state['closed']:
+                    return
+                ready.append((tunnel.host, ret))
+                # Only wakes the consumer if it is waiting on us; the
+                # consumer may be running other operations between yields.
+                waiter.wake()
+            return cb
+
+        def start():
+            for t in tunnels:
+                getattr(t, method)(make_callback(t), *args, **kwargs)
+
         try:
-            return loop.run()
+            waiter.call(start)
         except:
             self.close()
             raise
 
-    def connect(self):
-        """Connect all tunnels."""
-        self._connect(force=True)
+        def iter_results(pending):
+            try:
+                while pending:
+                    if not ready:
+                        try:
+                            waiter.wait()
+                        except:
+                            self.close()
+                            raise
+                        if not ready:
+                            if waiter.threaded:
+                                continue
+                            raise RuntimeError(
+                                'IOLoop stopped with %d results outstanding' %
+                                pending
+                            )
+                    pending -= 1
+                    yield ready.popleft()
+            finally:
+                # If the consumer stops iterating early, any outstanding
+                # results are ignored.
+                state['closed'] = True
+        return iter_results(len(ready) + len(tunnels))
+
+    def connect(self, timeout=None, max_parallel=None):
+        """Connect all tunnels.
+
+        If `timeout` is given, tunnels that do not connect within `timeout`
+        seconds are recorded as having failed to connect.
+
+        If `max_parallel` is given, at most this many tunnels will be
+        connecting at once.
+
+        """
+        self._connect(
+            force=True,
+            timeout=timeout,
+            max_parallel=max_parallel or self.max_parallel
+        )
+
+    def aconnect(self, timeout=None, max_parallel=None):
+        """Connect all tunnels from a coroutine.
 
-    def _connect(self, force=False):
+        This is the :mod:`asyncio` counterpart of :meth:`connect()`, used as
+        ``await group.aconnect()``. Requires Python 3.5 or later.
+
+        """
+        from .aio import group_connect
+        return group_connect(
+            self, timeout,
+            max_parallel=max_parallel or self.max_parallel
+        )
+
+    def _connect(self, force=False, timeout=None, max_parallel=None):
         """Connect all disconnected tunnels.
 
         Return a list of the tunnels we ended up connecting. Connection errors
@@ -152,7 +333,16 @@ class Group(SetOps):
 
         if not disconnected_tunnels:
             return connected_tunnels
-        result = self._parallel(disconnected_tunnels, '_connect_async')
+        if max_parallel:
+            result = self._rolling(
+                [(t, ()) for t in disconnected_tunnels],
+                None, {}, timeout, max_parallel
+            )
+        else:
+            result = self._parallel(
+                disconnected_tunnels, '_connect_async',
+                timeout=timeout
+            )
 
         self.connection_errors = {
             host: err
@@ -182,6 +372,16 @@ class Group(SetOps):
         for t in self.tunnels:
             t.close()
 
+    def aclose(self):
+        """Close all tunnels from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`close()`, which
+        waits for the remote processes to exit.
+
+        """
+        from .aio import group_close
+        return group_close(self)
+
     def __enter__(self):
         """Connect all tunnels."""
         self.connect()
@@ -199,14 +399,66 @@ class Group(SetOps):
         be serialisable as JSON, in order to ensure the orchestration host
         cannot be compromised through pickle attacks.
 
+        The keyword argument `timeout` is reserved: if given, it is the number
+        of seconds to wait for hosts to connect and return a result. Hosts
+        that do not respond in time are given an :class:`ErrorResult`, and
+        their late responses are discarded. It is not passed to the callable.
+
+        The keyword argument `max_parallel` is also reserved; if given, at
+        most this many hosts will be connecting or running the callable at
+        once (see :ref:`rolling`).
+
         The return value is a :class:`GroupResult`.
 
         """
-        tunnels = self._connect()
+        timeout = kwargs.pop('timeout', None)
+        max_parallel = kwargs.pop('max_parallel', None) or self.max_parallel
+        tunnels = self._usable_tunnels()
+        call = prepare_call(tunnels, callable, args, kwargs)
+        if max_parallel:
+            return self._rolling(
+                [(t, call) for t in tunnels],
+                '_call_async', {}, timeout, max_parallel
+            )
         return self._parallel(
-            tunnels,
-            '_call_async',
-            callable, *args, **kwargs
+            tunnels, '_call_async', *call, timeout=timeout
+        )
+
+    def acall(self, callable, *args, **kwargs):
+        """Call the given callable on all hosts, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`call()`, used as
+        ``await group.acall(callable, ...)``, and accepts the same reserved
+        keyword arguments. Tunnels are connected on the running event loop.
+
+        """
+        from .aio import group_call
+        timeout = kwargs.pop('timeout', None)
+        max_parallel = kwargs.pop('max_parallel', None) or self.max_parallel
+        return group_call(
+            self, callable, args, kwargs, timeout, max_parallel
+        )
+
+    def call_iter(self, callable, *args, **kwargs):
+        """Call the given callable on all hosts, yielding results as they come.
+
+        This is like :meth:`call()` except that rather than waiting for all
+        hosts to respond, it returns an iterator of ``(host, result)`` pairs
+        in the order that results are received. Failures are yielded as
+        :class:`ErrorResult` objects.
+
+        This allows results to be processed while slower hosts are still
+        working. It is safe to perform other Chopsticks operations while
+        iterating; results that arrive in the meantime are queued.
+
+        The keyword argument `timeout` is reserved, as for :meth:`call()`.
+
+        """
+        timeout = kwargs.pop('timeout', None)
+        tunnels = self._usable_tunnels()
+        call = prepare_call(tunnels, callable, args, kwargs)
+        return self._iter_parallel(
+            tunnels, '_call_async', *call, timeout=timeout
         )
 
     @staticmethod
@@ -222,7 +474,12 @@ class Group(SetOps):
         else:
             return ((t, None) for t in tunnels)
 
-    def fetch(self, remote_path, local_path=None):
+    def fetch(
+            self,
+            remote_path,
+            local_path=None,
+            timeout=None,
+            max_parallel=None):
         """Fetch files from all remote hosts.
 
         If `local_path` is given, it is a local path template, into which
@@ -236,6 +493,12 @@ class Group(SetOps):
         If `local_path` is not given, a temporary file will be used for
         each host.
 
+        If `timeout` is given, hosts that do not complete the transfer within
+        `timeout` seconds are given an :class:`ErrorResult`.
+
+        If `max_parallel` is given, at most this many hosts will be
+        transferring at once.
+
         Return a :class:`GroupResult` of dicts, each containing:
 
         * ``local_path`` - the local path written to
@@ -244,21 +507,47 @@ class Group(SetOps):
         * ``sha1sum`` - a sha1 checksum of the file data
 
         """
-        tunnels = self._connect()
-
-        self._new_op()
-        for tun, local_path in self._local_paths(tunnels, local_path):
-            tun._fetch_async(
-                self.op.make_callback(tun.host),
-                remote_path, local_path
+        max_parallel = max_parallel or self.max_parallel
+        if max_parallel:
+            paths = self._local_paths(self._usable_tunnels(), local_path)
+            return self._rolling(
+                [(t, (remote_path, lp)) for t, lp in paths],
+                '_fetch_async', {}, timeout, max_parallel
             )
-        try:
-            return loop.run()
-        except:
-            self.close()
-            raise
+        paths = self._local_paths(self._usable_tunnels(), local_path)
+        return self._parallel_jobs(
+            [(t, (remote_path, lp)) for t, lp in paths],
+            '_fetch_async',
+            {'timeout': timeout}
+        )
+
+    def afetch(
+            self,
+            remote_path,
+            local_path=None,
+            timeout=None,
+            max_parallel=None):
+        """Fetch files from all remote hosts, from a coroutine.
 
-    def put(self, local_path, remote_path=None, mode=0o644):
+        This is the :mod:`asyncio` counterpart of :meth:`fetch()`.
+
+        """
+        from .aio import group_op
+        paths = self._local_paths(self._usable_tunnels(), local_path)
+        return group_op(
+            self,
+            [(t, (remote_path, lp)) for t, lp in paths],
+            '_fetch_async', {}, timeout,
+            max_parallel or self.max_parallel
+        )
+
+    def put(
+            self,
+            local_path,
+            remote_path=None,
+            mode=0o644,
+            timeout=None,
+            max_parallel=None):
         """Copy a file to all remote hosts.
 
         If remote_path is given, it is the remote path to write to. Otherwise,
@@ -271,6 +560,12 @@ class Group(SetOps):
         This operation supports arbitarily large files (file data is streamed,
         not buffered in memory).
 
+        If `timeout` is given, hosts that do not complete the transfer within
+        `timeout` seconds are given an :class:`ErrorResult`.
+
+        If `max_parallel` is given, at most this many hosts will be
+        transferring at once.
+
         Return a :class:`GroupResult` of dicts, each containing:
 
         * ``remote_path`` - the absolute remote path
@@ -278,12 +573,101 @@ class Group(SetOps):
         * ``sha1sum`` - a sha1 checksum of the file data
 
         """
-        tunnels = self._connect()
+        max_parallel = max_parallel or self.max_parallel
+        if max_parallel:
+            return self._rolling(
+                [
+                    (t, (local_path, remote_path, mode))
+                    for t in self._usable_tunnels()
+                ],
+                '_put_async', {}, timeout, max_parallel
+            )
         return self._parallel(
-            tunnels, '_put_async',
-            local_path, remote_path, mode
+            self._usable_tunnels(), '_put_async',
+            local_path, remote_path, mode,
+            timeout=timeout
         )
 
+    def aput(
+            self,
+            local_path,
+            remote_path=None,
+            mode=0o644,
+            timeout=None,
+            max_parallel=None):
+        """Copy a file to all remote hosts, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`put()`.
+
+        """
+        from .aio import group_op
+        return group_op(
+            self,
+            [
+                (t, (local_path, remote_path, mode))
+                for t in self._usable_tunnels()
+            ],
+            '_put_async', {}, timeout,
+            max_parallel or self.max_parallel
+        )
+
+    def preload(self, modules, timeout=None):
+        """Send the source of the named modules to all hosts ahead of time.
+
+        Each module is sent together with the pure-Python modules it
+        imports, in one message per host, so that calls using them later do
+        not wait on a round trip to the controller for each import. Modules
+        in the standard library are not sent.
+
+        Tunnels are connected first if necessary. If `timeout` is given,
+        tunnels that do not connect within `timeout` seconds are recorded
+        as having failed to connect. This returns once the modules have been
+        written to every host.
+
+        """
+        names = import_closure(modules)
+        tunnels = self._connect(timeout=timeout)
+        for t in tunnels:
+            t._check_blocking()
+
+        def start(on_done):
+            pending = [len(tunnels)]
+
+            def flushed():
+                pending[0] -= 1
+                if not pending[0]:
+                    on_done(None)
+
+            if not tunnels:
+                on_done(None)
+            for t in tunnels:
+                t._preload(names)
+                t.writer.flush(flushed)
+        run_op(start)
+
+    def batches(self, size):
+        """Split the group into successive Groups of at most `size` hosts.
+
+        This is useful for rolling deploys, where each batch should complete
+        successfully before the next is started::
+
+            for batch in group.batches(10):
+                batch.call(deploy).raise_failures()
+
+        """
+        if size < 1:
+            raise ValueError('Batch size must be at least 1')
+        cls = type(self)
+        for i in range(0, len(self.tunnels), size):
+            tunnels = self.tunnels[i:i + size]
+            batch = cls(tunnels)
+            batch.max_parallel = self.max_parallel
+            for t in tunnels:
+                if t.host in self.connection_errors:
+                    batch.connection_errors[t.host] = \
+                        self.connection_errors[t.host]
+            yield batch
+
     def __repr__(self):
         return '%s(%r)' % (type(self).__name__, self.tunnels)
 
@@ -2,12 +2,25 @@ from __future__ import print_function
 import sys
 import os
 import fcntl
+import errno
 import struct
 import weakref
-from threading import RLock
+import time
+import itertools
+import atexit
+import traceback
+from heapq import heappush, heappop
+from collections import deque
+from threading import Lock, RLock, Thread, current_thread
 from select import select
 
-from .pencode import pencode, pdecode
+try:
+    import selectors
+except ImportError:
+    # Python < 3.4 does not have the selectors module
+    selectors = None
+
+from .pencode import pencode_into, PDecoder, DEFAULT_PROTOCOL
 
 __metaclass__ = type
 
@@ -17,6 +30,12 @@ PY2 = sys.version_info < (3,)
 if PY2:
     bytes = str
 
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python < 3.3
+    monotonic = time.time
+
 
 def nonblocking_fd(fd):
     if hasattr(fd, 'fileno'):
@@ -31,15 +50,48 @@ MSG_BYTES = 1
 MSG_PENCODE = 2
 
 
-class MessageReader:
-    """Read whole JSON messages from a fd using a chunked protocol."""
-    def __init__(self, ioloop, fd, tunnel):
-        self.loop = ioloop
-        self.fd = nonblocking_fd(fd)
+if hasattr(os, 'readv'):
+    def readinto(fd, view):
+        """Read from fd directly into the writable buffer view."""
+        return os.readv(fd, [view])
+else:
+    def readinto(fd, view):
+        """Read from fd into the writable buffer view.
+
+        Python < 3.3 has no os.readv() so we have to copy.
+
+        """
+        chunk = os.read(fd, len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class MessageDecoder:
+    """Decode framed messages from a buffer and pass them to a tunnel.
+
+    Payloads of ``MSG_BYTES`` frames are passed to the tunnel as memoryview
+    slices of the buffer, which are only valid for the duration of the
+    callback. Messages are only dispatched while the decoder is running.
+
+    If the tunnel's ``lazy_bytes`` is set, large bytes values in pencoded
+    frames are also passed as memoryviews of the buffer. The decoder then
+    moves on to a new buffer, so these remain valid.
+
+    """
+    #: The initial size of the receive buffer
+    BUFSIZE = 256 * 1024
+
+    #: The minimum amount of free space to read into
+    MIN_READ = 64 * 1024
+
+    def __init__(self, tunnel):
         self.tunnel = weakref.ref(tunnel)
-        self.buf = b''
-        self.need = HEADER.size
-        self.msgsize = None
+        self.lazy_bytes = getattr(tunnel, 'lazy_bytes', False)
+        self.buf = bytearray(self.BUFSIZE)
+        self.pos = 0  # offset of the first unconsumed byte
+        self.end = 0  # offset of the end of the data read
+        self.need = HEADER.size  # bytes needed to complete the next frame
+        self.running = False
 
     @property
     def callback(self):
@@ -58,38 +110,112 @@ class MessageReader:
     def _abort(self, *args):
         self.stop()
 
-    def on_data(self):
-        chunk = os.read(self.fd, max(1, self.need - len(self.buf)))
-        if not chunk:
-            self.errback('Unexpected EOF on stream')
+    def stop(self):
+        self.running = False
+
+    def _reserve(self, size=MIN_READ):
+        """Ensure there is space in the buffer to read `size` bytes into.
+
+        Unconsumed data is moved to the start of the buffer, which is grown
+        if necessary to hold the whole of the next frame.
+
+        """
+        pending = self.end - self.pos
+        if not pending and len(self.buf) > self.BUFSIZE:
+            # Release the memory used by a large message
+            self.buf = bytearray(self.BUFSIZE)
+            self.pos = self.end = 0
+        want = max(self.need, pending + size)
+        if self.pos + want <= len(self.buf):
             return
-        self.buf += chunk
-        self.loop.want_read(self.fd, self.on_data)
+        if want <= len(self.buf):
+            self.buf[:pending] = self.buf[self.pos:self.end]
+        else:
+            buf = bytearray(want)
+            buf[:pending] = self.buf[self.pos:self.end]
+            self.buf = buf
+        self.pos = 0
+        self.end = pending
+
+    def _detach(self):
+        """Move unconsumed data to a new buffer, returning it.
+
+        The old buffer is left to the memoryviews of it that were passed on.
+
+        """
+        pending = self.end - self.pos
+        buf = bytearray(max(self.BUFSIZE, pending))
+        buf[:pending] = self.buf[self.pos:self.end]
+        self.buf = buf
+        self.pos = 0
+        self.end = pending
+        return buf
+
+    def feed(self, data):
+        """Append data that has been received, and dispatch messages."""
+        size = len(data)
+        self._reserve(size)
+        self.buf[self.end:self.end + size] = data
+        self.end += size
         self._check()
 
     def _check(self):
-        """Check if the message size has been reached."""
-        while self.running and len(self.buf) >= self.need:
-            chunk = self.buf[:self.need]
-            self.buf = self.buf[self.need:]
-            if self.msgsize is None:
-                self.msgsize, self.req_id, self.op, self.fmt = \
-                    HEADER.unpack(chunk)
-                self.need = self.msgsize
-            else:
-                self.msgsize = None
+        """Dispatch all complete messages in the buffer."""
+        buf = self.buf
+        while self.running:
+            avail = self.end - self.pos
+            if avail < HEADER.size:
                 self.need = HEADER.size
-                if self.fmt == MSG_PENCODE:
-                    try:
-                        data = pdecode(chunk)
-                    except ValueError as e:
-                        self.errback(e.args[0])
-                        return
-                elif self.fmt == MSG_BYTES:
-                    data = chunk
-                else:
-                    raise ValueError('Unknown message format %s' % self.fmt)
-                self.callback((self.op, self.req_id, data))
+                break
+            msgsize, req_id, op, fmt = HEADER.unpack_from(buf, self.pos)
+            self.need = HEADER.size + msgsize
+            if avail < self.need:
+                break
+            start = self.pos + HEADER.size
+            end = self.pos = start + msgsize
+            chunk = memoryview(buf)[start:end]
+            if fmt == MSG_PENCODE:
+                decoder = PDecoder(self.lazy_bytes)
+                try:
+                    data = decoder.decode(chunk)
+                except ValueError as e:
+                    self.errback(e.args[0])
+                    return
+                if decoder.views:
+                    buf = self._detach()
+            elif fmt == MSG_BYTES:
+                data = chunk
+            else:
+                raise ValueError('Unknown message format %s' % fmt)
+            self.callback((op, req_id, data))
+
+
+class MessageReader(MessageDecoder):
+    """Read whole messages from a fd using a chunked protocol.
+
+    Data is read in large chunks directly into the decoder's buffer, and all
+    complete frames in the buffer are dispatched on each wakeup.
+
+    """
+    def __init__(self, ioloop, fd, tunnel):
+        super(MessageReader, self).__init__(tunnel)
+        self.loop = ioloop
+        self.fd = nonblocking_fd(fd)
+
+    def on_data(self):
+        self._reserve()
+        try:
+            n = readinto(self.fd, memoryview(self.buf)[self.end:])
+        except (OSError, IOError) as e:
+            self.stop()
+            self.errback('Error reading stream: %s' % e)
+            return
+        if not n:
+            self.stop()
+            self.errback('Unexpected EOF on stream')
+            return
+        self.end += n
+        self._check()
 
     def start(self):
         self.running = True
@@ -99,74 +225,185 @@ class MessageReader:
         self.running = False
         self.loop.abort_read(self.fd)
 
+    close = stop
+
+
+if hasattr(os, 'writev'):
+    writev = os.writev
+else:
+    def writev(fd, buffers):
+        """Write the first of buffers to fd.
+
+        Python < 3.3 has no os.writev(); the rest of the buffers will be
+        written on subsequent calls.
+
+        """
+        return os.write(fd, buffers[0])
+
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+if IOV_MAX < 1:
+    IOV_MAX = 16
+
 
 class MessageWriter:
+    """Write framed messages to a fd.
+
+    Frame headers and payloads are queued as separate buffers, and as many
+    queued buffers as possible are written with a single ``writev()`` call.
+    Partially written buffers are advanced with memoryview slices, so payloads
+    are never copied after they are encoded.
+
+    """
+    #: Stop gathering buffers for one write once we have this many bytes
+    WRITE_SIZE = 256 * 1024
+
+    #: The pencode protocol to write; raised once the remote end says it
+    #: can read a later version
+    pencode_protocol = DEFAULT_PROTOCOL
+
     def __init__(self, ioloop, fd):
         self.loop = ioloop
         self.fd = nonblocking_fd(fd)
-        self.queue = []
-        self.iter = None
-        self.chunk = b''
+
+        # A queue of memoryviews to write, or iterators of messages to
+        # encode once they reach the front of the queue
+        self.queue = deque()
+
+        # Callbacks waiting for the queue to empty
+        self.flushed = []
 
     def _encode(self, op, req_id, data):
-        """Encode the given message."""
-        if isinstance(data, dict):
-            data = pencode(data)
-            fmt = MSG_PENCODE
-        else:
-            fmt = MSG_BYTES
+        """Encode the given message, returning a list of buffers to write.
 
-        return HEADER.pack(len(data), req_id, op, fmt) + data
+        Structured data is encoded straight into one buffer after space
+        reserved for the header. Byte strings are not copied.
+
+        """
+        if isinstance(data, dict):
+            frame = bytearray(HEADER.size)
+            size = pencode_into(data, frame, self.pencode_protocol)
+            HEADER.pack_into(frame, 0, size, req_id, op, MSG_PENCODE)
+            return [frame]
+        header = HEADER.pack(len(data), req_id, op, MSG_BYTES)
+        if not data:
+            return [header]
+        return [header, data]
 
     def write(self, op, req_id, data):
-        self.write_raw(self._encode(op, req_id, data))
+        for buf in self._encode(op, req_id, data):
+            self.queue.append(memoryview(buf))
+        self.loop.want_write(self.fd, self.on_write)
 
     def write_raw(self, bytes):
         """Write a byte string to the fd."""
-        self.queue.append(bytes)
-        self.loop.want_write(self.fd, self.on_write)
+        if bytes:
+            self.queue.append(memoryview(bytes))
+            self.loop.want_write(self.fd, self.on_write)
 
     def write_iter(self, iterable):
         """Write messages from an iterable to the stream.
 
-        Each message must be JSON-serializable.
+        Each message must be a tuple of (op, req_id, data) as would be
+        passed to :meth:`write`. Messages are taken from the iterable only as
+        the stream can accept them.
 
         """
-        self.queue.append(iterable)
+        self.queue.append(iter(iterable))
         self.loop.want_write(self.fd, self.on_write)
 
+    def flush(self, callback):
+        """Call callback() once everything queued has been written.
+
+        The callback is also called if writing fails or the writer is
+        stopped, as nothing more will be written.
+
+        """
+        if self.queue:
+            self.flushed.append(callback)
+        else:
+            callback()
+
+    def _on_flushed(self):
+        self.loop.abort_write(self.fd)
+        callbacks, self.flushed = self.flushed, []
+        for callback in callbacks:
+            callback()
+
+    def _expand_iter(self):
+        """Encode messages from an iterator at the front of the queue.
+
+        Messages are placed in the queue ahead of the iterator, up to
+        WRITE_SIZE bytes. Exhausted iterators are removed.
+
+        """
+        q = self.queue
+        it = q.popleft()
+        bufs = []
+        size = 0
+        while size < self.WRITE_SIZE and len(bufs) < IOV_MAX:
+            try:
+                msg = next(it)
+            except StopIteration:
+                break
+            for buf in self._encode(*msg):
+                bufs.append(memoryview(buf))
+                size += len(buf)
+        else:
+            q.appendleft(it)
+        q.extendleft(reversed(bufs))
+
+    def _gather(self):
+        """Get a list of buffers to pass to writev()."""
+        q = self.queue
+        while q and not isinstance(q[0], memoryview):
+            self._expand_iter()
+        bufs = []
+        size = 0
+        for buf in q:
+            if not isinstance(buf, memoryview):
+                break
+            bufs.append(buf)
+            size += len(buf)
+            if size >= self.WRITE_SIZE or len(bufs) >= IOV_MAX:
+                break
+        return bufs
+
+    def _consume(self, written):
+        """Remove written bytes from the front of the queue."""
+        q = self.queue
+        while written:
+            buf = q[0]
+            if written < len(buf):
+                q[0] = buf[written:]
+                return
+            written -= len(buf)
+            q.popleft()
+
     def on_write(self):
-        if not self.queue:
+        bufs = self._gather()
+        if not bufs:
+            self._on_flushed()
             return
         try:
-            written = os.write(self.fd, self.queue[0])
-        except OSError:
+            written = writev(self.fd, bufs)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
             # TODO: handle errors properly
-            import traceback
             traceback.print_exc()
+            self._on_flushed()
             return
-        b = self.queue[0] = self.queue[0][written:]
-        if not b:
-            self.queue.pop(0)
-            while True:  # may have to loop through empty iterables
-                if self.iter:
-                    try:
-                        msg = next(self.iter)
-                    except StopIteration:
-                        self.iter = None
-                    else:
-                        self.queue.insert(0, self._encode(*msg))
-                        break
-                if not self.queue:
-                    return
-                if isinstance(self.queue[0], bytes):
-                    break
-                self.iter = self.queue.pop(0)
-        self.loop.want_write(self.fd, self.on_write)
+        self._consume(written)
+        if not self.queue:
+            self._on_flushed()
 
     def stop(self):
-        self.loop.abort_write(self.fd)
-        del self.queue[:]
+        self.queue.clear()
+        self._on_flushed()
 
 
 class StderrReader:
@@ -181,10 +418,9 @@ class StderrReader:
     def on_data(self):
         chunk = os.read(self.fd, 512)
         if not chunk:
-            self._flush()
+            self.stop()
             return
         self.buf += chunk
-        self.loop.want_read(self.fd, self.on_data)
         self._check()
 
     def println(self, l):
@@ -218,73 +454,377 @@ class StderrReader:
         self.stop()
 
 
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+class SelectPoller:
+    """Poll for fd readiness with select.select().
+
+    This is available everywhere but costs O(n) in the number of registered
+    fds per call, and cannot handle fd numbers above FD_SETSIZE (usually 1024).
+
+    """
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    modify = register
+
+    def unregister(self, fd):
+        del self.fds[fd]
+
+    def poll(self, timeout=None):
+        rfds = [fd for fd, ev in self.fds.items() if ev & EVENT_READ]
+        wfds = [fd for fd, ev in self.fds.items() if ev & EVENT_WRITE]
+        rs, ws, xs = select(rfds, wfds, rfds + wfds, timeout)
+        ready = {}
+        for fd in rs:
+            ready[fd] = EVENT_READ
+        for fd in ws:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        for fd in xs:
+            # Report errors as readiness; the callback will then see the
+            # error or EOF when it tries to read or write.
+            ready[fd] = ready.get(fd, 0) | self.fds[fd]
+        return list(ready.items())
+
+    def close(self):
+        self.fds.clear()
+
+
+class SelectorsPoller:
+    """Poll for fd readiness with the best available selectors backend.
+
+    On Linux this is epoll, where registrations persist in the kernel, so the
+    cost of a wakeup depends only on the number of ready fds.
+
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fd, events):
+        self.selector.register(fd, events)
+
+    def modify(self, fd, events):
+        self.selector.modify(fd, events)
+
+    def unregister(self, fd):
+        self.selector.unregister(fd)
+
+    def poll(self, timeout=None):
+        return [
+            (key.fd, events)
+            for key, events in self.selector.select(timeout)
+        ]
+
+    def close(self):
+        self.selector.close()
+
+
+#: Available polling backends, by name
+BACKENDS = {
+    'select': SelectPoller,
+}
+if selectors:
+    BACKENDS['selectors'] = SelectorsPoller
+    DEFAULT_BACKEND = 'selectors'
+else:
+    DEFAULT_BACKEND = 'select'
+
+
+class Timer:
+    """A handle for a function scheduled to be called by an IOLoop."""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the call, if it has not already happened."""
+        self.cancelled = True
+        self.callback = self.args = None
+
+    def __repr__(self):
+        return '<Timer %r at %.3f%s>' % (
+            self.callback, self.when, ' cancelled' if self.cancelled else ''
+        )
+
+
 class IOLoop:
     """An IO loop allowing the servicing of multiple tunnels with one thread.
 
     There are many event loops available in Python; this one is particularly
     crude, but avoids introducing another dependency.
 
+    `backend` selects how fds are polled - ``'selectors'`` (epoll, kqueue etc,
+    the default where available) or ``'select'``. Registrations are kept in
+    the poller between steps and only updated when the set of events we are
+    interested in for a fd changes.
+
+    Callbacks are level-triggered and persistent: a callback registered with
+    :meth:`want_read` or :meth:`want_write` is called every time the fd is
+    ready until it is removed with :meth:`abort_read` or :meth:`abort_write`.
+
+    Functions can also be scheduled to be called after a delay with
+    :meth:`call_later` or at a given time with :meth:`call_at`. The loop
+    keeps running while there are fds or timers to service.
+
+    Normally the loop is run by whichever thread is waiting for a result.
+    Alternatively, :meth:`start_thread` runs the loop forever in a
+    background thread; other threads must then use
+    :meth:`call_soon_threadsafe` to interact with it.
+
     """
-    def __init__(self):
+    def __init__(self, backend=None):
         self.read = {}
         self.write = {}
         self.err = {}
         self.result = None
         self.running = False
+        self.thread = None
+        self.threaded = False  # True if running in a background thread
         self.breakr, self.breakw = os.pipe()
 
+        self.backend = backend or DEFAULT_BACKEND
+        try:
+            self.poller = BACKENDS[self.backend]()
+        except KeyError:
+            raise ValueError('Unknown IOLoop backend %r' % backend)
+        self.poller.register(self.breakr, EVENT_READ)
+
+        # fds currently registered with the poller, and their event masks
+        self.registered = {}
+        # fds whose callbacks have changed since they were last registered
+        self.dirty = set()
+        # fds that were dropped entirely and then wanted again before we
+        # updated the poller; they may have been closed and reopened
+        self.renew = set()
+
+        # A heap of (when, seq, timer) for scheduled calls
+        self.timers = []
+        self.timer_seq = itertools.count()
+
+        # Calls scheduled from other threads
+        self.pending = deque()
+
+        # Events to set when a loop running in a background thread stops, so
+        # that threads waiting on it notice
+        self.stop_events = weakref.WeakSet()
+        self.stop_events_lock = Lock()
+
         # Maintain a lock so that only one thread can be running the loop
-        # at once. This makes the loop re-entrant (but the way the loop is
-        # called is not yet threadsafe).
+        # at once. This makes the loop re-entrant; other threads can safely
+        # interact with a running loop through call_soon_threadsafe().
         self.lock = RLock()
 
         # Hold a reference to os functions we need in shutting down
         self.os_write = os.write
         self.os_read = os.read
 
+    def _check_renew(self, fd):
+        """Note if fd is wanted again after being dropped entirely."""
+        if fd not in self.read and fd not in self.write and \
+                fd in self.registered:
+            self.renew.add(fd)
+
     def want_write(self, fd, callback):
+        self._check_renew(fd)
+        new = fd not in self.write
         self.write[fd] = callback
-        self.break_select()
+        if new:
+            self.dirty.add(fd)
+            self.break_select()
 
     def want_read(self, fd, callback):
+        self._check_renew(fd)
+        new = fd not in self.read
         self.read[fd] = callback
-        self.break_select()
+        if new:
+            self.dirty.add(fd)
+            self.break_select()
 
     def abort_read(self, fd):
         if self.read.pop(fd, None) is not None:
+            self.dirty.add(fd)
             self.break_select()
 
     def abort_write(self, fd):
         if self.write.pop(fd, None) is not None:
+            self.dirty.add(fd)
             self.break_select()
 
     def break_select(self):
-        """Cause the select.select() to break to pick up new fds.
+        """Cause the poll to break to pick up new fds.
+
+        This is done by including a pipe in the fds we poll, to which we can
+        write. Writing to this pipe will cause the poll to return early. The
+        bytes written are discarded.
 
-        This is done by including a pipe in the fds passed to select, to which
-        we can write. Writing to this pipe will cause select to return early.
-        The bytes written are discarded.
+        This is only necessary if the loop is being modified from a thread
+        other than the one running it; changes made from within callbacks are
+        picked up before the next poll anyway.
 
         """
-        if self.running:
+        if self.running and current_thread() is not self.thread:
             self.os_write(self.breakw, b'x')
 
+    #: The clock used for scheduling timers
+    time = staticmethod(monotonic)
+
+    def call_at(self, when, callback, *args):
+        """Schedule callback(*args) to be called at time `when`.
+
+        `when` is measured by the loop's :meth:`time` clock. Return a
+        :class:`Timer` that can be used to cancel the call.
+
+        """
+        timer = Timer(when, callback, args)
+        heappush(self.timers, (when, next(self.timer_seq), timer))
+        self.break_select()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Schedule callback(*args) to be called after `delay` seconds.
+
+        Return a :class:`Timer` that can be used to cancel the call.
+
+        """
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def _next_timer(self):
+        """Return the time of the next active timer, or None.
+
+        Cancelled timers at the head of the heap are discarded.
+
+        """
+        timers = self.timers
+        while timers:
+            when, _, timer = timers[0]
+            if not timer.cancelled:
+                return when
+            heappop(timers)
+        return None
+
+    def _run_timers(self):
+        """Call all timers that are due."""
+        now = self.time()
+        timers = self.timers
+        while timers:
+            when, _, timer = timers[0]
+            if timer.cancelled:
+                heappop(timers)
+                continue
+            if when > now:
+                break
+            heappop(timers)
+            callback, args = timer.callback, timer.args
+            timer.cancel()
+            callback(*args)
+
+    def _update_registrations(self):
+        """Bring the poller's registrations in line with our callbacks."""
+        dirty = self.dirty
+        while dirty:
+            fd = dirty.pop()
+            events = 0
+            if fd in self.read:
+                events |= EVENT_READ
+            if fd in self.write:
+                events |= EVENT_WRITE
+            current = self.registered.get(fd, 0)
+            if fd in self.renew:
+                # The kernel may have forgotten a closed fd whose number
+                # has been reused, so register it afresh
+                self.renew.discard(fd)
+                if current and events:
+                    try:
+                        self.poller.unregister(fd)
+                    except (OSError, IOError, KeyError, ValueError):
+                        pass
+                    del self.registered[fd]
+                    current = 0
+            if events == current:
+                continue
+            if not events:
+                del self.registered[fd]
+                try:
+                    self.poller.unregister(fd)
+                except (OSError, IOError, KeyError, ValueError):
+                    # The fd was closed under us
+                    pass
+                continue
+            self.registered[fd] = events
+            if current:
+                try:
+                    self.poller.modify(fd, events)
+                    continue
+                except (OSError, IOError, KeyError, ValueError):
+                    # The fd was closed and reopened, so the kernel has
+                    # forgotten it; register it afresh.
+                    try:
+                        self.poller.unregister(fd)
+                    except (OSError, IOError, KeyError, ValueError):
+                        pass
+            self.poller.register(fd, events)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Schedule callback(*args) to be called from the loop's thread.
+
+        This may be called from any thread.
+
+        """
+        self.pending.append((callback, args))
+        self.break_select()
+
+    def in_other_thread(self):
+        """Return True if the loop is running forever in another thread."""
+        return self.threaded and current_thread() is not self.thread
+
+    def notify_stopped(self, event):
+        """Set the given threading.Event when the background thread stops.
+
+        Return False if the loop is not running in a background thread.
+
+        """
+        with self.stop_events_lock:
+            if not self.threaded:
+                return False
+            self.stop_events.add(event)
+            return True
+
     def step(self):
-        rfds = list(self.read) + [self.breakr]
-        wfds = list(self.write)
-        rs, ws, xs = select(rfds, wfds, rfds + wfds)
-        if self.breakr in rs:
-            rs.remove(self.breakr)
-            self.os_read(self.breakr, 512)
-        for x in xs:
-            self.write.pop(x, None)
-            reader = self.read.pop(x, None)
-            if reader:
-                reader.errback('Error on stream')
-        for r in rs:
-            self.read.pop(r)()
-        for w in ws:
-            self.write.pop(w)()
+        self._update_registrations()
+        when = self._next_timer()
+        if self.pending:
+            timeout = 0
+        elif when is None:
+            timeout = None
+        else:
+            timeout = max(0, when - self.time())
+        ready = self.poller.poll(timeout)
+        for fd, events in ready:
+            if fd == self.breakr:
+                self.os_read(self.breakr, 512)
+                continue
+            if events & EVENT_READ:
+                callback = self.read.get(fd)
+                if callback:
+                    callback()
+            if events & EVENT_WRITE:
+                callback = self.write.get(fd)
+                if callback:
+                    callback()
+        if self.timers:
+            self._run_timers()
+        pending = self.pending
+        while pending:
+            callback, args = pending.popleft()
+            callback(*args)
 
     def reader(self, *args, **kwargs):
         return MessageReader(self, *args, **kwargs)
@@ -300,6 +840,75 @@ class IOLoop:
         with self.lock:
             self.result = None
             self.running = True
-            while self.running and (self.read or self.write):
-                self.step()
+            prev_thread = self.thread
+            self.thread = current_thread()
+            try:
+                while self.running and (
+                        self.read or self.write or self.pending or
+                        self._next_timer() is not None):
+                    self.step()
+            finally:
+                self.thread = prev_thread
         return self.result
+
+    def run_forever(self):
+        """Run the loop until stop_thread() is called.
+
+        Unlike :meth:`run`, this is not interrupted by :meth:`stop`, nor when
+        there is nothing to do. Exceptions raised by callbacks are printed
+        rather than stopping the loop, as other threads depend on it.
+
+        """
+        with self.lock:
+            self.running = True
+            self.threaded = True
+            self.thread = current_thread()
+            try:
+                while self.threaded:
+                    self.running = True
+                    try:
+                        self.step()
+                    except Exception:
+                        # fds are level-triggered, and timers and pending
+                        # calls are only removed as they are called, so
+                        # anything this step did not get to is run next time
+                        traceback.print_exc()
+            finally:
+                self.running = False
+                with self.stop_events_lock:
+                    self.threaded = False
+                    events = list(self.stop_events)
+                    self.stop_events.clear()
+                self.thread = None
+                for event in events:
+                    event.set()
+
+    def start_thread(self):
+        """Start running the loop forever in a background thread.
+
+        Once started, operations on tunnels can be performed safely from any
+        number of threads; each thread blocks only until its own result
+        arrives.
+
+        """
+        if self.threaded:
+            return
+        t = Thread(target=self.run_forever, name='chopsticks-ioloop')
+        t.daemon = True
+        t.start()
+        # Stop before interpreter shutdown freezes the daemon thread, so that
+        # tunnels closed after that do not wait on it
+        atexit.register(self.stop_thread)
+        # Wait for the thread to take ownership of the loop
+        while not self.threaded:
+            time.sleep(0.001)
+
+    def stop_thread(self):
+        """Stop a loop started with start_thread()."""
+        if self.threaded:
+            thread = self.thread
+            self.call_soon_threadsafe(self._stop_forever)
+            thread.join()
+
+    def _stop_forever(self):
+        self.threaded = False
@@ -8,11 +8,27 @@ than encoding bytes-as-base64-in-JSON.
 import sys
 import struct
 import codecs
+from itertools import chain, islice
 
 SZ = struct.Struct('!I')
 REF = struct.Struct('!cI')
+BYTE = struct.Struct('!B')
+INT64 = struct.Struct('!q')
+DOUBLE = struct.Struct('!d')
+
+#: The highest version of the encoding that can be written. Version 2 adds
+#: binary encodings for ints and floats; version 3 does not give references
+#: to ints and floats. All versions can be decoded.
+HIGHEST_PROTOCOL = 3
+
+#: The version written unless another is requested, which any peer can read.
+DEFAULT_PROTOCOL = 1
 
 utf8_decode = codecs.getdecoder('utf8')
+ascii_decode = codecs.getdecoder('ascii')
+
+#: The size from which bytes values may be decoded as memoryviews
+LAZY_BYTES_MIN = 64 * 1024
 
 
 PY3 = sys.version_info >= (3,)
@@ -42,13 +58,44 @@ except (KeyError, AttributeError):
             self.bytes = bytestring
 
 
-def pencode(obj):
+def pencode(obj, protocol=DEFAULT_PROTOCOL):
     """Encode the given Python primitive structure, returning a byte string."""
-    p = Pencoder()
+    p = Pencoder(protocol)
     p._pencode(obj, p.backrefs, p.out)
     return p.getvalue()
 
 
+def pencode_into(obj, buf, protocol=DEFAULT_PROTOCOL):
+    """Encode obj onto the end of the bytearray buf.
+
+    The encoding is appended in chunks as it is produced, so it is never
+    held in memory twice. Return the number of bytes appended.
+
+    """
+    extend = buf.extend
+
+    def writelines(fragments):
+        for fragment in fragments:
+            extend(fragment)
+
+    p = Pencoder(protocol, writelines)
+    p._pencode(obj, p.backrefs, p.out)
+    p.flush()
+    return p.written
+
+
+def pencode_to(obj, fileobj, protocol=DEFAULT_PROTOCOL):
+    """Encode obj, writing it to the binary file object fileobj in chunks.
+
+    Return the number of bytes written.
+
+    """
+    p = Pencoder(protocol, fileobj.writelines)
+    p._pencode(obj, p.backrefs, p.out)
+    p.flush()
+    return p.written
+
+
 def bsz(seq):
     """Encode the length of a sequence as big-endian 4-byte uint."""
     return SZ.pack(len(seq))
@@ -78,6 +125,42 @@ def _pencode_float(obj):
     bs = repr(float(obj)).encode('ascii')
     return [b'f', bsz(bs), bs]
 
+
+def zigzag_varint(n):
+    """Encode a signed int of up to 64 bits as a zigzag varint.
+
+    Small magnitudes, positive or negative, take the fewest bytes.
+
+    """
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+# Ints that fit in one varint byte are looked up here. Longer varints are
+# slower to encode and decode in pure Python than fixed-width ints, so
+# other ints up to 64 bits are written fixed-width.
+SMALL_INTS = dict(
+    (n, b'v' + zigzag_varint(n)) for n in range_(-64, 64)
+)
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+def _pencode_int_v2(obj):
+    small = SMALL_INTS.get(obj)
+    if small is not None:
+        return [small]
+    if INT64_MIN <= obj <= INT64_MAX:
+        return [b'I', INT64.pack(obj)]
+    return _pencode_int(obj)
+
+def _pencode_float_v2(obj):
+    return [b'D', DOUBLE.pack(obj)]
+
 SEQTYPE_CODES = {
     set: b'q',
     frozenset: b'Q',
@@ -96,51 +179,185 @@ VALTYPE_FUNCS = {
     float: _pencode_float,
 }
 
+VALTYPE_FUNCS_V2 = dict(VALTYPE_FUNCS)
+VALTYPE_FUNCS_V2.update({
+    int: _pencode_int_v2,
+    long: _pencode_int_v2,
+    float: _pencode_float_v2,
+})
+
+PROTOCOL_FUNCS = {
+    1: VALTYPE_FUNCS,
+    2: VALTYPE_FUNCS_V2,
+    3: VALTYPE_FUNCS_V2,
+}
+
+# Numbers are rarely shared, and are no bigger than a reference in protocol
+# 2, so from protocol 3 they are not given references. Strings are still
+# given references, because the keys of result dicts are often shared.
+NUMBER_TYPES = frozenset([int, long, float])
+NUMBER_CODES = frozenset([b'v', b'I', b'D', b'i', b'f'])
+
+# Codes of containers, and of the mutable containers, which are given their
+# reference before their items are decoded
+CONTAINER_CODES = frozenset(CODE_SEQTYPES) | frozenset([b'd'])
+MUTABLE_CODES = frozenset([b'l', b'q', b'd'])
+
+# Struct formats of the numbers that can be decoded in bulk
+FIXED_WIDTH_FORMATS = {
+    b'v': 'B',  # a varint of one byte
+    b'I': 'q',
+    b'D': 'd',
+}
+
+# The number of encoded fragments to collect before passing them on
+FLUSH_FRAGMENTS = 4096
+
+
 class Pencoder(object):
-    def __init__(self):
-        self.out = []
+    def __init__(self, protocol=DEFAULT_PROTOCOL, writelines=None):
+        try:
+            self.valtype_funcs = PROTOCOL_FUNCS[protocol]
+        except KeyError:
+            raise ValueError('Unsupported pencode protocol %r' % protocol)
+        if protocol < 3:
+            self.unreferenced = frozenset()
+            self.out = []
+        else:
+            # Tell the decoder that numbers have no references
+            self.unreferenced = NUMBER_TYPES
+            self.out = [b'P', BYTE.pack(protocol)]
         self.backrefs = {
             id(None): b'n',
             id(False): b'F',
             id(True): b'T',
         }
 
+        # If writelines is given, lists of encoded fragments are passed to it
+        # as they are produced, rather than collected in self.out
+        self.writelines = writelines
+        self.written = 0
+        self.flush_at = FLUSH_FRAGMENTS if writelines else sys.maxsize
+
     def getvalue(self):
         return b''.join(self.out)
 
+    def flush(self):
+        """Pass the data encoded so far to self.writelines."""
+        out = self.out
+        self.written += sum(map(len, out))
+        self.writelines(out)
+        del out[:]
+
     def _pencode(self, obj, backrefs, out):
-        """Inner function for encoding of structures."""
-        objid = id(obj)
-        if objid in backrefs:
-            out.append(backrefs[objid])
-            return
-        else:
-            backrefs[objid] = REF.pack(b'R', len(backrefs))
-
-        otype = type(obj)
-        if otype in VALTYPE_FUNCS:
-            func = VALTYPE_FUNCS[otype]
-            out.extend(func(obj))
-        elif otype in SEQTYPE_CODES:
-            code = SEQTYPE_CODES[otype]
-            out.extend([code, bsz(obj)])
-            _pencode = self._pencode
-            for item in obj:
-                _pencode(item, backrefs, out)
-        elif isinstance(obj, dict):
-            out.extend([b'd', bsz(obj)])
-            _pencode = self._pencode
-            for k in obj:
-                _pencode(k, backrefs, out)
-                _pencode(obj[k], backrefs, out)
+        """Inner function for encoding of structures.
+
+        Iterators over the containers being encoded are kept on a stack,
+        rather than recursing, so structures of any depth can be encoded.
+
+        """
+        valtype_funcs = self.valtype_funcs
+        unreferenced = self.unreferenced
+        flush_at = self.flush_at
+        stack = [iter((obj,))]
+        while stack:
+            for obj in stack[-1]:
+                otype = type(obj)
+                if otype in unreferenced:
+                    out.extend(valtype_funcs[otype](obj))
+                    continue
+
+                objid = id(obj)
+                if objid in backrefs:
+                    out.append(backrefs[objid])
+                    continue
+                backrefs[objid] = REF.pack(b'R', len(backrefs))
+
+                if otype in valtype_funcs:
+                    out.extend(valtype_funcs[otype](obj))
+                elif otype in SEQTYPE_CODES:
+                    out.extend([SEQTYPE_CODES[otype], bsz(obj)])
+                    if not self._pencode_scalars(obj, backrefs, out):
+                        if len(obj) > flush_at:
+                            stack.extend(self._chunks(iter(obj), len(obj)))
+                        else:
+                            stack.append(iter(obj))
+                        break
+                elif isinstance(obj, dict):
+                    out.extend([b'd', bsz(obj)])
+                    items = chain.from_iterable(obj.items())
+                    if len(obj) * 2 > flush_at:
+                        stack.extend(self._chunks(items, len(obj) * 2))
+                    else:
+                        stack.append(items)
+                    break
+                else:
+                    raise ValueError('Unserialisable type %s' % type(obj))
+            else:
+                stack.pop()
+            if len(out) >= flush_at:
+                self.flush()
+
+    def _chunks(self, it, n):
+        """Split an iterator over n items into chunks, to push on the stack.
+
+        Output is checked for flushing as each chunk is finished, which
+        bounds it even within a long container of scalars.
+
+        """
+        size = self.flush_at
+        chunks = [islice(it, size) for _ in range(0, n, size)]
+        chunks.reverse()
+        return chunks
+
+    def _pencode_scalars(self, seq, backrefs, out):
+        """Encode the items of seq if they are all of one scalar type.
+
+        Return False, having encoded nothing, if they are not.
+
+        """
+        types = set(map(type, seq))
+        if not types:
+            return True
+        if len(types) > 1:
+            return False
+        otype = types.pop()
+        func = self.valtype_funcs.get(otype)
+        if func is None:
+            return False
+
+        if self.writelines and len(seq) > FLUSH_FRAGMENTS:
+            # Flush between chunks of a long sequence
+            it = iter(seq)
+            chunks = iter(lambda: list(islice(it, FLUSH_FRAGMENTS)), [])
         else:
-            raise ValueError('Unserialisable type %s' % type(obj))
+            chunks = [seq]
+
+        unreferenced = otype in self.unreferenced
+        for chunk in chunks:
+            if len(out) >= self.flush_at:
+                self.flush()
+            if unreferenced:
+                for item in chunk:
+                    out.extend(func(item))
+                continue
+
+            for item in chunk:
+                itemid = id(item)
+                ref = backrefs.get(itemid)
+                if ref is None:
+                    backrefs[itemid] = REF.pack(b'R', len(backrefs))
+                    out.extend(func(item))
+                else:
+                    out.append(ref)
+        return True
 
 
 class obuf(object):
     """Wrapper to unpack data from a buffer."""
     def __init__(self, buf):
         self.buf = buf
+        self.view = memoryview(buf)
         self.offset = 0
 
     def read_size(self):
@@ -153,14 +370,62 @@ class obuf(object):
         end = self.offset = start + n
         return self.buf[start:end]
 
+    def read_view(self, n):
+        """Read n bytes as a memoryview of the buffer, without copying."""
+        start = self.offset
+        end = self.offset = start + n
+        return self.view[start:end]
+
+    def read_struct(self, st):
+        v = st.unpack_from(self.buf, self.offset)[0]
+        self.offset += st.size
+        return v
+
+    def read_varint(self):
+        """Read a zigzag varint."""
+        n = self.read_struct(BYTE)
+        if n < 0x80:
+            return (n >> 1) ^ -(n & 1)
+        n &= 0x7f
+        shift = 7
+        while True:
+            b = self.read_struct(BYTE)
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        return (n >> 1) ^ -(n & 1)
+
+
+class oview(obuf):
+    """Wrapper to unpack data from a memoryview or other buffer."""
+    def __init__(self, buf):
+        super(oview, self).__init__(memoryview(buf))
+
+    def read_bytes(self, n):
+        start = self.offset
+        end = self.offset = start + n
+        return self.buf[start:end].tobytes()
+
+
+def pdecode(buf, lazy_bytes=False):
+    """Decode a pencoded byte string or other buffer to a structure.
 
-def pdecode(buf):
-    """Decode a pencoded byte string to a structure."""
-    return PDecoder().decode(buf)
+    Strings are decoded directly from the buffer. If lazy_bytes is True,
+    bytes values of at least LAZY_BYTES_MIN bytes are returned as memoryviews
+    of the buffer rather than copied; the buffer must not be modified while
+    they are in use.
+
+    """
+    return PDecoder(lazy_bytes).decode(buf)
 
 
 class PDecoder(object):
-    def __init__(self):
+    def __init__(self, lazy_bytes=False):
+        self.lazy_bytes = lazy_bytes
+        #: The number of values decoded as memoryviews of the buffer
+        self.views = 0
+        self.number_refs = True
         self.br_count = 3
         self.backrefs = {
             b'n': None,
@@ -169,62 +434,158 @@ class PDecoder(object):
         }
 
     def decode(self, buf):
-        return self._decode(obuf(buf))
+        if isinstance(buf, (bytes_, py2str)):
+            return self._decode(obuf(buf))
+        return self._decode(oview(buf))
 
     def _decode(self, obuf):
+        """Decode one structure from obuf.
+
+        The containers being decoded are kept on a stack, rather than
+        recursing, so structures of any depth can be decoded.
+
+        """
+        backrefs = self.backrefs
+        read_bytes = obuf.read_bytes
+        read_size = obuf.read_size
+        # Python 2 can't decode text from a memoryview
+        read_text = read_bytes if PY2 else obuf.read_view
+        lazy_bytes = self.lazy_bytes
+        br_count = self.br_count
+        number_refs = self.number_refs
+
+        # Frames of [code, container, items remaining, backref id, dict key].
+        # The items of tuples and frozensets are collected in a list.
+        stack = []
+        while True:
+            code = read_bytes(1)
+            if code in backrefs:
+                obj = backrefs[code]
+            elif code == b'R':
+                obj = backrefs[read_size()]
+            elif code == b'P':
+                # Protocol 3+ encodings start with the protocol version
+                number_refs = self.number_refs = obuf.read_struct(BYTE) < 3
+                continue
+            else:
+                if number_refs or code not in NUMBER_CODES:
+                    br_id = br_count
+                    br_count += 1
+                else:
+                    br_id = None
+
+                if code == b'v':
+                    obj = obuf.read_varint()
+                elif code == b'I':
+                    obj = obuf.read_struct(INT64)
+                elif code == b'D':
+                    obj = obuf.read_struct(DOUBLE)
+                elif code == b'b':
+                    sz = read_size()
+                    if lazy_bytes and sz >= LAZY_BYTES_MIN:
+                        obj = obuf.read_view(sz)
+                        self.views += 1
+                    else:
+                        obj = read_bytes(sz)
+                elif code == b's':
+                    obj = utf8_decode(read_text(read_size()))[0]
+                elif code == b'S':
+                    if PY2:
+                        obj = read_bytes(read_size())
+                    else:
+                        obj = ascii_decode(read_text(read_size()))[0]
+                elif code == b'i':
+                    obj = int(read_bytes(read_size()))
+                elif code == b'f':
+                    obj = float(read_bytes(read_size()))
+                elif code in CONTAINER_CODES:
+                    sz = read_size()
+                    if code == b'd':
+                        obj = {}
+                        sz *= 2
+                    elif code == b'q':
+                        obj = set()
+                    else:
+                        obj = []
+                    if code in MUTABLE_CODES:
+                        backrefs[br_id] = obj
+                    if sz and code != b'd':
+                        items = self._decode_numbers(obuf, sz)
+                        if items is not None:
+                            if code == b'q':
+                                obj.update(items)
+                            else:
+                                obj.extend(items)
+                            sz = 0
+                    if sz:
+                        stack.append([code, obj, sz, br_id, None])
+                        continue
+                    if code == b't':
+                        obj = tuple(obj)
+                    elif code == b'Q':
+                        obj = frozenset(obj)
+                else:
+                    raise ValueError('Unknown pack opcode %r' % code)
+
+                if br_id is not None:
+                    backrefs[br_id] = obj
+
+            # Add obj to its container, and any containers now complete to
+            # theirs, until one is incomplete or the structure is done
+            while stack:
+                frame = stack[-1]
+                code = frame[0]
+                container = frame[1]
+                if code == b'l' or code == b't' or code == b'Q':
+                    container.append(obj)
+                elif code == b'q':
+                    container.add(obj)
+                elif frame[2] % 2:
+                    container[frame[4]] = obj
+                else:
+                    frame[4] = obj
+                frame[2] -= 1
+                if frame[2]:
+                    break
+
+                stack.pop()
+                if code == b't':
+                    obj = tuple(container)
+                    backrefs[frame[3]] = obj
+                elif code == b'Q':
+                    obj = frozenset(container)
+                    backrefs[frame[3]] = obj
+                else:
+                    obj = container
+            else:
+                self.br_count = br_count
+                return obj
+
+    def _decode_numbers(self, obuf, sz):
+        """Decode sz unreferenced numbers of one fixed-width type at once.
+
+        Return None, having decoded nothing, if the next sz items are not
+        of this form.
+
+        """
+        if self.number_refs or PY2:
+            return None
+        buf = obuf.buf
+        start = obuf.offset
         code = obuf.read_bytes(1)
-        if code in self.backrefs:
-            return self.backrefs[code]
-
-        if code == b'R':
-            ref_id = obuf.read_size()
-            obj = self.backrefs[ref_id]
-            return obj
-
-        br_id = self.br_count
-        self.br_count += 1
-
-        if code == b'b':
-            sz = obuf.read_size()
-            obj = obuf.read_bytes(sz)
-        elif code == b's':
-            sz = obuf.read_size()
-            obj = utf8_decode(obuf.read_bytes(sz))[0]
-        elif code == b'S':
-            sz = obuf.read_size()
-            obj = obuf.read_bytes(sz)
-            if not PY2:
-                obj = obj.decode('ascii')
-        elif code == b'i':
-            sz = obuf.read_size()
-            obj = int(obuf.read_bytes(sz))
-        elif code == b'f':
-            sz = obuf.read_size()
-            obj = float(obuf.read_bytes(sz))
-        elif code == b'l':
-            sz = obuf.read_size()
-            obj = []
-            self.backrefs[br_id] = obj
-            obj.extend(self._decode(obuf) for _ in range_(sz))
-        elif code == b'q':
-            sz = obuf.read_size()
-            obj = set()
-            self.backrefs[br_id] = obj
-            obj.update(self._decode(obuf) for _ in range_(sz))
-        elif code in (b't', b'Q'):
-            cls = tuple if code == b't' else frozenset
-            sz = obuf.read_size()
-            obj = cls(self._decode(obuf) for _ in range_(sz))
-        elif code == b'd':
-            sz = obuf.read_size()
-            obj = {}
-            self.backrefs[br_id] = obj
-            for _ in range_(sz):
-                key = self._decode(obuf)
-                value = self._decode(obuf)
-                obj[key] = value
-        else:
-            raise ValueError('Unknown pack opcode %r' % code)
-
-        self.backrefs[br_id] = obj
-        return obj
+        obuf.offset = start
+        fmt = FIXED_WIDTH_FORMATS.get(code)
+        if fmt is None:
+            return None
+        width = struct.calcsize('!' + fmt) + 1
+        end = start + width * sz
+        if end > len(buf) or buf[start:end:width] != code * sz:
+            return None
+        values = struct.unpack_from('!' + ('x' + fmt) * sz, buf, start)
+        if code == b'v':
+            if max(values) >= 0x80:
+                # Longer varints
+                return None
+            values = [(n >> 1) ^ -(n & 1) for n in values]
+        obuf.offset = end
+        return values
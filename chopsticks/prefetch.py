@@ -0,0 +1,110 @@
+"""Find the modules to send to a remote host ahead of a call.
+
+Without prefetching, each module imported on a remote host costs a round
+trip to the controller. Instead, before a call is sent, the controller
+finds the pure-Python import closure of the callable's module using
+:mod:`modulefinder` and sends the source of all of it in one message.
+
+Modules in the standard library are left out, as the remote host will
+import its own copy. Modules that are not pure Python (extension modules,
+for example) are also left out, as they could not be imported from source
+anyway.
+
+"""
+import os
+import sys
+import sysconfig
+from modulefinder import ModuleFinder
+
+from .serialise_main import execute_func
+
+
+def _dir(path):
+    """Return path as an absolute directory prefix."""
+    return os.path.join(os.path.abspath(path), '')
+
+
+_paths = sysconfig.get_paths()
+STDLIB = _dir(_paths['stdlib'])
+SITE_DIRS = tuple(set(_dir(_paths[k]) for k in ('purelib', 'platlib')))
+del _paths
+
+
+def is_stdlib(path):
+    """Return True if path is a file in the standard library."""
+    path = os.path.abspath(path)
+    return path.startswith(STDLIB) and not path.startswith(SITE_DIRS)
+
+
+class Finder(ModuleFinder):
+    """A ModuleFinder that does not follow imports within the stdlib.
+
+    The standard library is not sent to remote hosts, so there is no need
+    to spend time scanning it.
+
+    """
+    def load_module(self, fqname, fp, pathname, file_info):
+        if pathname and fp and is_stdlib(pathname):
+            m = self.add_module(fqname)
+            m.__file__ = pathname
+            return m
+        return ModuleFinder.load_module(self, fqname, fp, pathname, file_info)
+
+
+# Import closures of modules we have already searched, by module name
+closures = {}
+
+
+def module_closure(modname):
+    """Get the names of the pure-Python modules that modname may import.
+
+    This includes modname itself, and its parent packages. Modules that
+    cannot be found or analysed have an empty closure.
+
+    """
+    try:
+        return closures[modname]
+    except KeyError:
+        pass
+    finder = Finder(path=sys.path)
+    try:
+        finder.import_hook(modname)
+    except Exception:
+        # Syntax errors, missing modules or anything else modulefinder
+        # could not cope with; fall back to importing on demand
+        closure = frozenset()
+    else:
+        closure = frozenset(
+            name for name, m in finder.modules.items()
+            if m.__file__
+            and m.__file__.endswith('.py')
+            and not is_stdlib(m.__file__)
+        )
+    closures[modname] = closure
+    return closure
+
+
+def import_closure(modules):
+    """Get the names of the pure-Python modules that modules may import."""
+    names = set()
+    for modname in modules:
+        names.update(module_closure(modname))
+    return names
+
+
+def callable_modules(params):
+    """Get the names of the modules that a prepared call needs.
+
+    `params` is a (callable, args, kwargs) tuple as returned by
+    :func:`.prepare_callable`.
+
+    """
+    func, args, kwargs = params
+    mods = set()
+    modname = getattr(func, '__module__', None)
+    if modname and modname != '__main__':
+        mods.add(modname)
+    if func is execute_func:
+        # Functions from __main__ carry the names of the modules they use
+        mods.update(args[0][2])
+    return mods
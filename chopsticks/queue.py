@@ -4,7 +4,7 @@ import sys
 import traceback
 from functools import partial
 from collections import deque
-from .tunnel import loop, PY2, BaseTunnel
+from .tunnel import PY2, BaseTunnel, run_op, prepare_call
 from .group import Group, GroupOp
 
 __metaclass__ = type
@@ -81,6 +81,7 @@ class Queue:
     def __init__(self):
         self.queued = {}
         self.running = False
+        self.on_done = None
 
     def _enqueue_group(self, methname, group, args, kwargs):
         """Enqueue an operation on a Group of tunnels."""
@@ -113,8 +114,8 @@ class Queue:
                 queue[0]()
             else:
                 del self.queued[tunnel]
-                if not self.queued:
-                    loop.stop()
+                if not self.queued and self.on_done:
+                    self.on_done(None)
 
         bound = partial(async_func, callback, *args, **kwargs)
         queue.append(bound)
@@ -145,22 +146,39 @@ class Queue:
         return enqueue
 
     connect = mkhandler('connect')
-    call = mkhandler('call')
     fetch = mkhandler('fetch')
     put = mkhandler('put')
 
     del mkhandler
 
+    # call finds the modules to send ahead of the call once, up front:
+
+    def call(self, target, callable, *args, **kwargs):
+        """Queue a :meth:`~chopsticks.tunnel.BaseTunnel.call()` operation to be run on the target.  """  # noqa
+        timeout = kwargs.pop('timeout', None)
+        if isinstance(target, BaseTunnel):
+            m, tunnels = self._enqueue_tunnel, [target]
+        elif isinstance(target, Group):
+            m, tunnels = self._enqueue_group, target.tunnels
+        else:
+            raise TypeError('Invalid target; expected Tunnel or Group')
+        call = prepare_call(tunnels, callable, args, kwargs)
+        return m('call', target, call, {'timeout': timeout})
+
     # fetch is slightly different because it constructs different local paths
     # for each host:
 
-    def fetch(self, target, remote_path, local_path=None):
+    def fetch(self, target, remote_path, local_path=None, timeout=None):
         """Queue a :meth:`~chopsticks.tunnel.BaseTunnel.fetch()` operation to be run on the target.  """  # noqa
         if isinstance(target, BaseTunnel):
             return self._enqueue_tunnel(
                 'fetch', target,
                 (),
-                {'remote_path': remote_path, 'local_path': local_path}
+                {
+                    'remote_path': remote_path,
+                    'local_path': local_path,
+                    'timeout': timeout,
+                }
             )
 
         async_result = AsyncResult()
@@ -168,7 +186,11 @@ class Queue:
         for tun, local_path in Group._local_paths(target.tunnels, local_path):
             r = self._enqueue_tunnel(
                 'fetch', tun, (),
-                {'remote_path': remote_path, 'local_path': local_path}
+                {
+                    'remote_path': remote_path,
+                    'local_path': local_path,
+                    'timeout': timeout,
+                }
             )
             r.with_callback(op.make_callback(tun.host))
         return async_result
@@ -179,12 +201,18 @@ class Queue:
         This method does not return until the queue is empty.
 
         """
-        self.running = True
-        try:
-            for host, queue in iteritems(self.queued):
+        def start(on_done):
+            self.running = True
+            self.on_done = on_done
+            for host, queue in list(iteritems(self.queued)):
                 if not queue:
                     continue
                 queue[0]()
-            loop.run()
+            if not self.queued:
+                on_done(None)
+
+        try:
+            run_op(start)
         finally:
             self.running = False
+            self.on_done = None
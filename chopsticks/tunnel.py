@@ -7,13 +7,20 @@ import pkgutil
 import threading
 import tempfile
 import time
+import traceback
+import io
+import functools
+import tokenize
+import zlib
 from hashlib import sha1
+from collections import OrderedDict
 
 import chopsticks
 from . import ioloop
 from .setops import SetOps
 from .serialise_main import prepare_callable
-from .pencode import Bytes
+from .prefetch import import_closure, callable_modules
+from .pencode import Bytes, HIGHEST_PROTOCOL as PENCODE_PROTOCOL
 
 
 PY2 = sys.version_info < (3,)
@@ -74,14 +81,380 @@ class ErrorResult:
     __unicode__ = __repr__
 
 
+class Discard:
+    """Stands in for the callback of a request that has timed out.
+
+    Any late response to the request is ignored.
+
+    """
+    def __call__(self, result):
+        pass
+
+    def recv(self, data):
+        pass
+
+
+discard = Discard()
+
+
+def remaining(deadline):
+    """Return the number of seconds until deadline, or None for no deadline."""
+    if deadline is None:
+        return None
+    return max(0, deadline - loop.time())
+
+
+def deadline_for(timeout):
+    """Return the loop time at which a timeout expires."""
+    if timeout is None:
+        return None
+    return loop.time() + timeout
+
+
 class RemoteException(Exception):
     """An exception from the remote agent."""
 
 
+class WaitTimeout(RemoteException):
+    """Timed out waiting locally for the result of an operation.
+
+    The operation itself has not failed, and may still complete later.
+
+    """
+
+
+class Waiter:
+    """Block the current thread until woken by a callback on the loop.
+
+    If the loop is running in a background thread (see
+    :meth:`.IOLoop.start_thread`), this waits on an Event. Otherwise the
+    waiting thread runs the loop itself until woken.
+
+    """
+    def __init__(self):
+        self.threaded = loop.in_other_thread()
+        if self.threaded:
+            self.event = threading.Event()
+            loop.notify_stopped(self.event)
+        self.waiting = False
+        # Exceptions raised by functions passed to call()
+        self.errors = []
+
+    def wake(self):
+        """Wake the waiting thread. Called from the loop thread."""
+        if self.threaded:
+            self.event.set()
+        elif self.waiting:
+            loop.stop()
+
+    def wait(self, timeout=None):
+        """Wait until woken, or for at most `timeout` seconds.
+
+        Callers should check for the condition they are waiting for after
+        this returns, as it may return spuriously.
+
+        Raise any exception from a function passed to :meth:`call`, or
+        RuntimeError if the loop's background thread has stopped.
+
+        """
+        if self.threaded:
+            if loop.threaded:
+                self.event.wait(timeout)
+            self.event.clear()
+            if self.errors:
+                raise self.errors.pop(0)
+            if not loop.threaded:
+                raise RuntimeError('The IOLoop thread has stopped')
+            return
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, loop.stop)
+        self.waiting = True
+        try:
+            loop.run()
+        finally:
+            self.waiting = False
+            if timer:
+                timer.cancel()
+
+    def call(self, func, *args):
+        """Call func in the loop's thread, without waiting for it.
+
+        If the loop is running in another thread, an exception raised by
+        func is passed back to be raised by the next :meth:`wait`, rather
+        than reaching the loop.
+
+        """
+        if not self.threaded:
+            func(*args)
+            return
+
+        def call_safe():
+            try:
+                func(*args)
+            except Exception as e:
+                self.errors.append(e)
+                self.wake()
+        loop.call_soon_threadsafe(call_safe)
+
+
+def run_op(start):
+    """Run an asynchronous operation and wait for its result.
+
+    `start` is called, in the loop's thread, with a callback that should be
+    called with the result of the operation.
+
+    """
+    waiter = Waiter()
+    result = []
+
+    def on_result(value):
+        result.append(value)
+        waiter.wake()
+
+    waiter.call(start, on_result)
+    if not waiter.threaded:
+        if not result:
+            waiter.wait()
+        return result[0] if result else None
+    while not result:
+        waiter.wait()
+    return result[0]
+
+
+class Future:
+    """The eventual result of an operation submitted to a tunnel.
+
+    See :meth:`BaseTunnel.submit()`.
+
+    """
+    # Sentinel for no value received yet
+    PENDING = object()
+
+    def __init__(self, host=None):
+        #: The host the operation was submitted to
+        self.host = host
+        self._value = self.PENDING
+        # An exception to raise from result() in place of the value
+        self._exception = None
+        self._callbacks = []
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return True if the result has been received."""
+        return self._value is not self.PENDING
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when the result is received.
+
+        The callback is called in the loop's thread. Exceptions it raises
+        are printed and otherwise ignored.
+
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _add_waiter(self, waiter):
+        with self._lock:
+            if not self.done():
+                self._waiters.append(waiter)
+
+    def _remove_waiter(self, waiter):
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _set(self, value):
+        with self._lock:
+            self._value = value
+            callbacks, self._callbacks = self._callbacks, []
+            waiters, self._waiters = self._waiters, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                # One bad callback must not stop the others, or the waiters,
+                # being called
+                traceback.print_exc()
+        for w in waiters:
+            w.wake()
+
+    def _set_exception(self, exc):
+        """Fail the operation with an exception raised locally."""
+        self._exception = exc
+        self._set(None)
+
+    def result(self, timeout=None):
+        """Wait for and return the result.
+
+        Raise RemoteException if the operation failed. If `timeout` is
+        given and the result is not received within `timeout` seconds,
+        raise :class:`WaitTimeout` instead, leaving the operation pending.
+
+        """
+        wait([self], timeout=timeout)
+        if not self.done():
+            raise WaitTimeout(
+                'Timed out waiting for result from host %r' % self.host
+            )
+        if self._exception is not None:
+            raise self._exception
+        if isinstance(self._value, ErrorResult):
+            raise RemoteException(self._value.msg)
+        return self._value
+
+
+def wait(futures, timeout=None):
+    """Wait until all the given futures are done.
+
+    If `timeout` is given, return after at most `timeout` seconds even if
+    some futures are still pending.
+
+    """
+    pending = [f for f in futures if not f.done()]
+    if not pending:
+        return
+    waiter = Waiter()
+    for f in pending:
+        f._add_waiter(waiter)
+    deadline = deadline_for(timeout)
+    try:
+        while pending:
+            if deadline is not None and not remaining(deadline):
+                break
+            waiter.wait(remaining(deadline))
+            pending = [f for f in pending if not f.done()]
+            if pending and not waiter.threaded and not (
+                    loop.read or loop.write):
+                # Nothing left that could complete the futures
+                break
+    finally:
+        for f in pending:
+            f._remove_waiter(waiter)
+
+
+def gather(futures, timeout=None):
+    """Wait for all the given futures and return a list of their results.
+
+    Raise RemoteException if any of the operations failed, or
+    :class:`WaitTimeout` if `timeout` is given and any are still pending
+    after `timeout` seconds.
+
+    """
+    futures = list(futures)
+    wait(futures, timeout=timeout)
+    return [f.result(timeout=0) for f in futures]
+
+
 class DepthLimitExceeded(Exception):
     """The recursive tunnel depth limit was hit."""
 
 
+class SourceCache:
+    """A cache of the modules the controller has served to remote hosts.
+
+    Entries are keyed by the name requested, and hold the resolved path and
+    the OP_IMP response for it. An entry is only used while the file's
+    modification time and size are unchanged, so edited modules are read
+    again. At most `maxsize` entries are kept, discarding the least recently
+    used.
+
+    Modules that could not be found are also remembered, up to `max_missing`
+    of them, until ``sys.path`` changes. These names are sent to remote
+    hosts so that they do not need to ask for them.
+
+    One cache is shared by all tunnels, as :data:`source_cache`.
+
+    """
+    def __init__(self, maxsize=1000, max_missing=1000):
+        self.maxsize = maxsize
+        self.max_missing = max_missing
+        self.entries = OrderedDict()
+        self.missing = OrderedDict()
+        self.missing_path = None
+        self.lock = threading.Lock()
+        #: The number of requests served from the cache
+        self.hits = 0
+        #: The number of requests that had to search sys.path
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def _check_path(self):
+        """Forget missing modules if sys.path has changed."""
+        if self.missing_path != sys.path:
+            self.missing.clear()
+            self.missing_path = list(sys.path)
+
+    def get(self, key):
+        """Get the cached response for key, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                path, stat, imp = entry
+                if self._stat(path) == stat:
+                    # Reinsert to mark as most recently used
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return imp
+            self._check_path()
+            imp = self.missing.get(key)
+            if imp is not None:
+                self.hits += 1
+                return imp
+            self.misses += 1
+            return None
+
+    def put(self, key, path, imp):
+        """Cache the response imp for key, read from path."""
+        stat = self._stat(path)
+        if stat is None:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (path, stat, imp)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def put_missing(self, key, imp):
+        """Remember that the module key was not found."""
+        with self.lock:
+            self._check_path()
+            self.missing[key] = imp
+            while len(self.missing) > self.max_missing:
+                self.missing.popitem(last=False)
+
+    def missing_names(self):
+        """Get the set of names of modules known not to exist."""
+        with self.lock:
+            self._check_path()
+            return set(self.missing)
+
+    def clear(self):
+        """Discard all entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.missing.clear()
+            self.hits = self.misses = 0
+
+
+#: The module cache shared by all tunnels
+source_cache = SourceCache()
+
+
 # Load/construct the bubble code
 try:
     # If this is the remote side, we have the bubble code in __main__.__bubble
@@ -93,18 +466,181 @@ except (AttributeError, KeyError):
     del pencode_bubble
 
 
+def minify(source):
+    """Strip comments and blank lines from Python source code, as bytes."""
+    lines = source.splitlines(True)
+    keep = set()
+    comments = {}
+    readline = io.StringIO(source.decode('utf8')).readline
+    skip = (
+        tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE,
+        tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER
+    )
+    for tok in tokenize.generate_tokens(readline):
+        toktype, start, end = tok[0], tok[2], tok[3]
+        if toktype == tokenize.COMMENT:
+            comments[start[0]] = start[1]
+        elif toktype not in skip:
+            keep.update(range(start[0], end[0] + 1))
+    out = []
+    for lineno, line in enumerate(lines, 1):
+        if lineno not in keep:
+            continue
+        if lineno in comments:
+            # Comments are ASCII in the bubble, so columns are byte offsets
+            line = line[:comments[lineno]].rstrip() + b'\n'
+        out.append(line)
+    return b''.join(out)
+
+
+# Bootstrap code and Python arguments, by (compress, minify)
+bootstraps = {}
+
+
+def bootstrap(compress=True, minify_code=False):
+    """Get the bubble code to send, and the Python arguments to receive it.
+
+    If `compress` is True, the bubble is compressed with zlib, and the
+    arguments decompress it before executing it. If `minify_code` is True,
+    comments and blank lines are stripped from it first.
+
+    """
+    key = (compress, minify_code)
+    try:
+        return bootstraps[key]
+    except KeyError:
+        pass
+    code = minify(bubble) if minify_code else bubble
+    if compress:
+        code = zlib.compress(code, 9)
+        cmd = (
+            'import sys, os, zlib; ' +
+            'inpipe = os.fdopen(os.dup(0), \'rb\'); ' +
+            '__bubble = zlib.decompress(inpipe.read(%d)); ' % len(code) +
+            'exec(compile(__bubble, \'bubble.py\', \'exec\'))'
+        )
+    else:
+        cmd = (
+            'import sys, os; _bsz = %d ;' % len(code) +
+            'inpipe = os.fdopen(os.dup(0), \'rb\', _bsz); ' +
+            '__bubble = inpipe.read(_bsz); ' +
+            'exec(compile(__bubble, \'bubble.py\', \'exec\'))'
+        )
+    bootstraps[key] = code, ['-usS', '-c', cmd]
+    return bootstraps[key]
+
+
+def prepare_call(tunnels, callable, args, kwargs):
+    """Prepare a call to be sent to the given tunnels.
+
+    Return a tuple ``(imports, callable, args, kwargs)`` of the arguments
+    for ``_call_async()``, where `imports` are the names of the modules to
+    send ahead of the call. They are only looked for if one of `tunnels`
+    prefetches imports.
+
+    Finding imports with :mod:`modulefinder` is slow, so this is called
+    before a call is scheduled rather than on the event loop.
+
+    """
+    params = prepare_callable(callable, args, kwargs)
+    if any(t.prefetch_imports for t in tunnels):
+        imports = import_closure(callable_modules(params))
+    else:
+        imports = frozenset()
+    return (imports,) + params
+
+
+def pipelined(method):
+    """Decorate an asynchronous operation to connect the tunnel if necessary.
+
+    Rather than waiting for the remote host to reply to the handshake, the
+    operation is sent straight after it, saving a round trip. If the tunnel
+    fails to connect, the operation's callback receives the connection
+    error instead of a result.
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, on_result, *args, **kwargs):
+        if self.connected:
+            return method(self, on_result, *args, **kwargs)
+        done = []
+
+        def once(res):
+            # A failed connection may also fail the operation itself
+            if not done:
+                done.append(res)
+                on_result(res)
+
+        def on_connect(res):
+            if isinstance(res, ErrorResult):
+                once(res)
+        self._connect_async(on_connect, timeout=kwargs.get('timeout'))
+        if not done:
+            method(self, once, *args, **kwargs)
+    return wrapper
+
+
 class BaseTunnel(SetOps):
     HIGHEST_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+    # Calls sent before the remote host has told us its highest pickle
+    # protocol use one that any remote of the same major version supports
+    PIPELINE_PICKLE_PROTOCOL = 2 if PY2 else 3
     connected = False
 
+    #: The number of worker threads the remote host uses to run calls and
+    #: fetches. Further operations are queued until a worker is free.
+    workers = 16
+
+    #: The number of messages the remote host may queue for sending back to
+    #: the controller before the operations producing them have to wait.
+    #: Raising this can improve fetch throughput over high-latency links.
+    queue_depth = 64
+
+    #: If True, send the source of the modules a callable may import in one
+    #: message before the call, rather than waiting for the remote host to
+    #: request each module as it is imported.
+    prefetch_imports = True
+
+    #: Keep the source and bytecode of modules sent to the remote host in a
+    #: cache on disk there, so that they are not sent or compiled again by
+    #: later connections. This may be True, to use the directory
+    #: ``chopsticks/modules`` in the remote user's cache directory
+    #: (``~/.cache`` by default), or the path of a directory on the remote
+    #: host. Off by default.
+    module_cache = False
+
+    #: If True, bytes values in results of at least
+    #: ``chopsticks.pencode.LAZY_BYTES_MIN`` bytes (64KiB) are returned as
+    #: memoryviews of the buffer they were received into, rather than copied
+    #: to new bytes objects. This halves the peak memory used to receive
+    #: large results. Off by default.
+    lazy_bytes = False
+
     def __init__(self):
         self._reset()
 
     def _reset(self):
+        for timer in getattr(self, 'timers', {}).values():
+            timer.cancel()
         self.req_id = 0
         self.callbacks = {}
+        self.timers = {}
+        self.streams = {}
         self.connected = False
+        self.connecting = None
         self.pickle_version = self.HIGHEST_PICKLE_PROTOCOL
+        # Operations that had to wait for a free remote worker, and the
+        # total time they waited
+        self.queued_ops = 0
+        self.queued_time = 0.0
+        # Modules whose source has been sent to the remote host
+        self.sent_imports = set()
+        # SHA-1 hashes of module sources in the remote host's module cache
+        self.remote_modules = set()
+        # The loop that drives this tunnel's I/O; tunnels connected from a
+        # coroutine are driven by the asyncio event loop instead
+        self.loop = loop
 
     def __eq__(self, ano):
         return self.host == ano.host
@@ -123,27 +659,95 @@ class BaseTunnel(SetOps):
         from chopsticks.group import Group
         return Group([self])
 
-    def _run_loop(self):
-        """Run the loop, but clean up after crashes."""
+    def _check_blocking(self):
+        """Raise RuntimeError if the tunnel cannot be used synchronously."""
+        if self.loop is not loop:
+            raise RuntimeError(
+                '%r is connected to an asyncio event loop; use the '
+                'coroutine methods such as acall() instead' % self
+            )
+
+    def _run_op(self, start):
+        """Run an operation to completion, but clean up after crashes."""
+        self._check_blocking()
         try:
-            return loop.run()
+            return run_op(start)
         except:
             self.close()
             raise
 
-    def connect(self):
+    def connect(self, timeout=None):
+        """Connect the tunnel.
+
+        If `timeout` is given, raise RemoteException if the connection is
+        not established within `timeout` seconds.
+
+        """
         if self.connected:
             return
         assert self.host, "No host name received"
-        self._connect_async(loop.stop)
-        res = self._run_loop()
+        res = self._run_op(
+            lambda cb: self._connect_async(cb, timeout=timeout)
+        )
         if isinstance(res, ErrorResult):
             raise RemoteException(res.msg)
 
-    def _connect_async(self, callback):
+    def _connect_async(self, callback, timeout=None):
         """Connect the tunnel."""
         raise NotImplementedError('Subclasses must implement _connect_async()')
 
+    def aconnect(self, timeout=None):
+        """Connect the tunnel from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`connect()`, used as
+        ``await tunnel.aconnect()``. A tunnel connected in this way is driven
+        by the running asyncio event loop, and can then only be used with
+        the coroutine methods :meth:`acall()`, :meth:`afetch()` and
+        :meth:`aput()`.
+
+        Requires Python 3.5 or later.
+
+        """
+        from .aio import connect
+        return connect(self, timeout=timeout)
+
+    def _set_timeout(self, req_id, timeout):
+        """Fail the request req_id if it takes longer than timeout seconds."""
+        if timeout is not None:
+            self.timers[req_id] = self.loop.call_later(
+                timeout, self._expire, req_id, timeout
+            )
+
+    def _expire(self, req_id, timeout):
+        """Fail a request that has timed out.
+
+        The request's callback is replaced so that any late response will be
+        discarded.
+
+        """
+        self.timers.pop(req_id, None)
+        cb = self.callbacks.get(req_id)
+        if cb is None:
+            return
+        self.callbacks[req_id] = discard
+
+        stream = self.streams.pop(req_id, None)
+        if stream:
+            # Stop sending data, and ask the remote to abandon the put
+            stream.close()
+            self.writer.write(OP_PUT_END, req_id, {'sha1sum': ''})
+
+        cb(ErrorResult(
+            'Timed out after %.3gs waiting for host %r' % (timeout, self.host)
+        ))
+        if req_id == 0:
+            # The tunnel is unusable if the connection did not complete
+            self._kill()
+
+    def _kill(self):
+        """Forcibly disconnect a tunnel that has stopped responding."""
+        self.close()
+
     def write_msg(self, op, req_id, data=None, **kwargs):
         """Write one message to the subprocess.
 
@@ -163,23 +767,44 @@ class BaseTunnel(SetOps):
         with open(file, 'rb') as f:
             return Bytes(f.read())
 
-    def handle_imp(self, mod):
+    def _find_imp(self, mod):
+        """Find the module or package data file requested as mod.
+
+        Return a dict of the fields of an OP_IMP response.
+
+        """
+        imp = source_cache.get(mod)
+        if imp is None:
+            path, imp = self._locate_imp(mod)
+            if path is not None:
+                if not isinstance(mod, tuple):
+                    # Identifies the source in remote module caches
+                    imp['sha1'] = sha1(imp['source'].bytes).hexdigest()
+                source_cache.put(mod, path, imp)
+            elif not imp['exists'] and not isinstance(mod, tuple):
+                source_cache.put_missing(mod, imp)
+        return imp
+
+    def _locate_imp(self, mod):
+        """Search sys.path for mod.
+
+        Return the path of the file found, if any, and a dict of the fields
+        of an OP_IMP response.
+
+        """
         key = mod
         fname = None
         if mod == '__main__':
             # Special-case main to find real main module
             main = sys.modules['__main__']
             path = main.__file__
-            self.write_msg(
-                OP_IMP,
-                0,
+            return path, dict(
                 mod=mod,
                 exists=True,
                 is_pkg=False,
                 file=os.path.basename(path),
                 source=self._read_source(path)
             )
-            return
         elif isinstance(mod, tuple):
             mod, fname = mod
             if not mod:
@@ -203,16 +828,14 @@ class BaseTunnel(SetOps):
                 except ImportError:
                     continue
                 else:
-                    self.write_msg(
-                        OP_IMP,
-                        0,
+                    return None, dict(
                         mod=key,
                         exists=imp.exists,
                         is_pkg=imp.is_pkg,
                         file=imp.file,
                         source=imp.source,
+                        sha1=imp.sha1,
                     )
-                    return
 
             for is_pkg, rel in paths:
                 path = os.path.join(root, rel)
@@ -224,19 +847,14 @@ class BaseTunnel(SetOps):
                         rel = stem + '/' + fname
                         is_pkg = False
 
-                    self.write_msg(
-                        OP_IMP,
-                        0,
+                    return path, dict(
                         mod=key,
                         exists=True,
                         is_pkg=is_pkg,
                         file=rel,
                         source=self._read_source(path)
                     )
-                    return
-        self.write_msg(
-            OP_IMP,
-            0,
+        return None, dict(
             mod=key,
             exists=False,
             is_pkg=False,
@@ -244,6 +862,59 @@ class BaseTunnel(SetOps):
             source=''
         )
 
+    def _new_missing(self):
+        """Get the modules known not to exist that the remote hasn't heard of.
+
+        These are then considered to have been sent.
+
+        """
+        missing = source_cache.missing_names() - self.sent_imports
+        self.sent_imports.update(missing)
+        return sorted(missing)
+
+    def _for_remote(self, mod, imp):
+        """Leave the source out of imp if the remote host has it cached.
+
+        A module that is requested again after being sent is always sent in
+        full, as the remote host may have failed to read its cached copy.
+
+        """
+        if (imp.get('sha1') in self.remote_modules
+                and mod not in self.sent_imports):
+            return dict(imp, source=None)
+        return imp
+
+    def handle_imp(self, mod):
+        imp = self._for_remote(mod, self._find_imp(mod))
+        self.sent_imports.add(mod)
+        missing = self._new_missing()
+        if missing:
+            # Let the remote resolve misses from other hosts by itself
+            imp = dict(imp, missing=missing)
+        self.write_msg(OP_IMP, 0, imp)
+
+    def _preload(self, names):
+        """Send the source of the named modules in one message.
+
+        Modules that have already been sent to the remote host, or that
+        cannot be found, are skipped.
+
+        """
+        names = set(names) - self.sent_imports
+        if not names:
+            return
+        batch = []
+        for mod in sorted(names):
+            imp = self._for_remote(mod, self._find_imp(mod))
+            if imp['exists']:
+                batch.append([
+                    mod, True, imp['is_pkg'], imp['file'], imp['source'],
+                    imp.get('sha1')
+                ])
+        self.sent_imports.update(names)
+        if batch:
+            self.write_msg(OP_IMP, 0, batch=batch)
+
     def _get_callback(self, req_id, data):
         try:
             return self.callbacks[req_id]
@@ -257,6 +928,10 @@ class BaseTunnel(SetOps):
     def _pop_callback(self, req_id, data):
         cb = self._get_callback(req_id, data)
         del self.callbacks[req_id]
+        self.streams.pop(req_id, None)
+        timer = self.timers.pop(req_id, None)
+        if timer:
+            timer.cancel()
         return cb
 
     def on_message(self, msg):
@@ -275,8 +950,22 @@ class BaseTunnel(SetOps):
         elif op == OP_IMP:
             self.handle_imp(data['imp'])
         elif op == OP_RET:
-            self.reader.stop()
-            self._pop_callback(req_id, data)(data['ret'])
+            wait = data.get('wait')
+            if wait is not None:
+                self.queued_ops += 1
+                self.queued_time += wait
+            cached = data.get('cached')
+            if cached:
+                # Sent in response to OP_START
+                self.remote_modules.update(cached)
+            pencode_protocol = data.get('pencode_protocol')
+            if pencode_protocol:
+                # Sent in response to OP_START; older agents don't send it
+                self.writer.pencode_protocol = pencode_protocol
+            cb = self._pop_callback(req_id, data)
+            if not self.callbacks:
+                self.reader.stop()
+            cb(data['ret'])
         elif op == OP_FETCH_DATA:
             self._get_callback(req_id, data).recv(data)
         else:
@@ -295,31 +984,98 @@ class BaseTunnel(SetOps):
         This is somewhat stricter than pickle, because using pickle for results
         would enable remote hosts to compromise the control host.
 
+        The keyword argument `timeout` is reserved: if given, it is the number
+        of seconds to wait for the connection and the call to complete before
+        raising RemoteException. It is not passed to the callable.
+
         """
-        self.connect()
-        self._call_async(loop.stop, callable, *args, **kwargs)
-        ret = self._run_loop()
+        deadline = deadline_for(kwargs.pop('timeout', None))
+        call = prepare_call([self], callable, args, kwargs)
+        ret = self._run_op(
+            lambda cb: self._call_async(
+                cb, *call, timeout=remaining(deadline)
+            )
+        )
         if isinstance(ret, ErrorResult):
             raise RemoteException(ret.msg)
         return ret
 
-    def _call_async(self, on_result, callable, *args, **kwargs):
+    def acall(self, callable, *args, **kwargs):
+        """Call the given callable on the remote host, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`call()`, used as
+        ``await tunnel.acall(callable, ...)``. The tunnel is connected with
+        :meth:`aconnect()` if necessary.
+
+        """
+        from .aio import call
+        return call(self, callable, *args, **kwargs)
+
+    def submit(self, callable, *args, **kwargs):
+        """Start calling the given callable on the remote host.
+
+        Rather than waiting for the result, return a :class:`Future`. Many
+        calls can be submitted before waiting for any of them, in which case
+        they are pipelined over the tunnel and run concurrently on the
+        remote host. Use :func:`gather()` to wait for several results.
+
+        Arguments are as for :meth:`call()`, including the reserved
+        `timeout` keyword argument.
+
+        If the loop is running in a background thread, errors in starting
+        the call, such as arguments that cannot be pickled, are raised by
+        the future's :meth:`~Future.result()` rather than here.
+
+        """
+        timeout = kwargs.pop('timeout', None)
+        deadline = deadline_for(timeout)
+        self._check_blocking()
+        call = prepare_call([self], callable, args, kwargs)
+        future = Future(self.host)
+        waiter = Waiter()
+
+        def start():
+            try:
+                self._call_async(
+                    future._set, *call, timeout=remaining(deadline)
+                )
+            except Exception as e:
+                if not waiter.threaded:
+                    raise
+                # Nobody is waiting on the loop thread for this, so the
+                # future must carry the error
+                future._set_exception(e)
+        waiter.call(start)
+        return future
+
+    @pipelined
+    def _call_async(self, on_result, imports, callable, args, kwargs,
+                    timeout=None):
+        params = (callable, args, kwargs)
+        if self.connected:
+            version = self.pickle_version
+        else:
+            version = min(self.pickle_version, self.PIPELINE_PICKLE_PROTOCOL)
+        # Serialise before registering the request, so that a callable that
+        # cannot be sent leaves nothing behind
+        data = pickle.dumps(params, version)
         id = self._next_id()
         self.callbacks[id] = on_result
-        params = prepare_callable(callable, args, kwargs)
+        self._set_timeout(id, timeout)
         self.reader.start()
-        self.write_msg(
-            OP_CALL,
-            req_id=id,
-            data=pickle.dumps(params, self.pickle_version)
-        )
+        if self.prefetch_imports:
+            self._preload(imports)
+        self.write_msg(OP_CALL, req_id=id, data=data)
 
-    def fetch(self, remote_path, local_path=None):
+    def fetch(self, remote_path, local_path=None, timeout=None):
         """Fetch one file from the remote host.
 
         If local_path is given, it is the local path to write to. Otherwise,
         a temporary filename will be used.
 
+        If `timeout` is given, raise RemoteException if the transfer does not
+        complete within `timeout` seconds.
+
         This operation supports arbitarily large files (file data is streamed,
         not buffered in memory).
 
@@ -331,17 +1087,37 @@ class BaseTunnel(SetOps):
         * ``sha1sum`` - a sha1 checksum of the file data
 
         """
-        self.connect()
-        self._fetch_async(loop.stop, remote_path, local_path)
-        ret = self._run_loop()
+        deadline = deadline_for(timeout)
+        ret = self._run_op(
+            lambda cb: self._fetch_async(
+                cb, remote_path, local_path,
+                timeout=remaining(deadline)
+            )
+        )
         if isinstance(ret, ErrorResult):
             raise RemoteException(ret.msg)
         return ret
 
-    def _fetch_async(self, on_result, remote_path, local_path=None):
+    def afetch(self, remote_path, local_path=None, timeout=None):
+        """Fetch one file from the remote host, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`fetch()`.
+
+        """
+        from .aio import fetch
+        return fetch(self, remote_path, local_path, timeout=timeout)
+
+    @pipelined
+    def _fetch_async(
+            self,
+            on_result,
+            remote_path,
+            local_path=None,
+            timeout=None):
         id = self._next_id()
         fetch = Fetch(on_result, local_path)
         self.callbacks[id] = fetch
+        self._set_timeout(id, timeout)
         self.reader.start()
         self.write_msg(
             OP_FETCH_BEGIN,
@@ -349,7 +1125,7 @@ class BaseTunnel(SetOps):
             path=remote_path,
         )
 
-    def put(self, local_path, remote_path=None, mode=0o644):
+    def put(self, local_path, remote_path=None, mode=0o644, timeout=None):
         """Copy a file to the remote host.
 
         If `remote_path` is given, it is the remote path to write to.
@@ -358,6 +1134,9 @@ class BaseTunnel(SetOps):
         `mode` gives is the permission bits of the file to create, or 0o644 if
         unspecified.
 
+        If `timeout` is given, raise RemoteException if the transfer does not
+        complete within `timeout` seconds.
+
         This operation supports arbitarily large files (file data is streamed,
         not buffered in memory).
 
@@ -368,21 +1147,37 @@ class BaseTunnel(SetOps):
         * ``sha1sum`` - a sha1 checksum of the file data
 
         """
-        self.connect()
-        self._put_async(loop.stop, local_path, remote_path, mode)
-        ret = self._run_loop()
+        deadline = deadline_for(timeout)
+        ret = self._run_op(
+            lambda cb: self._put_async(
+                cb, local_path, remote_path, mode,
+                timeout=remaining(deadline)
+            )
+        )
         if isinstance(ret, ErrorResult):
             raise RemoteException(ret.msg)
         return ret
 
+    def aput(self, local_path, remote_path=None, mode=0o644, timeout=None):
+        """Copy a file to the remote host, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`put()`.
+
+        """
+        from .aio import put
+        return put(self, local_path, remote_path, mode, timeout=timeout)
+
+    @pipelined
     def _put_async(
             self,
             on_result,
             local_path,
             remote_path=None,
-            mode=0o644):
+            mode=0o644,
+            timeout=None):
         id = self._next_id()
         self.callbacks[id] = on_result
+        self._set_timeout(id, timeout)
         self.reader.start()
         self.write_msg(
             OP_PUT_BEGIN,
@@ -390,9 +1185,8 @@ class BaseTunnel(SetOps):
             path=remote_path,
             mode=mode
         )
-        self.writer.write_iter(
-            iter_chunks(id, local_path)
-        )
+        chunks = self.streams[id] = iter_chunks(id, local_path)
+        self.writer.write_iter(chunks)
 
     def close():
         """Disconnect the tunnel.
@@ -401,9 +1195,22 @@ class BaseTunnel(SetOps):
         be lost. This does not destroy the Tunnel object, which can be
         reconnected with :meth:`.connect()`.
 
+        On a tunnel connected from a coroutine, this does not wait for the
+        remote process to exit; use :meth:`aclose()` to do so.
+
         """
         raise NotImplementedError()
 
+    def aclose(self):
+        """Disconnect the tunnel, from a coroutine.
+
+        This is the :mod:`asyncio` counterpart of :meth:`close()`. It waits
+        for the remote process to exit without blocking the event loop.
+
+        """
+        from .aio import close
+        return close(self)
+
 
 def iter_chunks(req_id, path):
     """Iterate over chunks of the given file.
@@ -470,10 +1277,41 @@ class PipeTunnel(BaseTunnel):
 
     """
 
-    def _connect_async(self, callback):
+    #: If True, send the agent code to the remote host compressed with zlib,
+    #: which takes around a third of the bytes. Set this to False if the
+    #: remote Python is built without zlib.
+    compress_bubble = True
+
+    #: If True, also strip comments and blank lines from the agent code
+    #: before sending it. This makes tracebacks from the agent itself harder
+    #: to read.
+    minify_bubble = False
+
+    def _bootstrap(self):
+        """Get the agent code to send, and the Python arguments to run it."""
+        return bootstrap(self.compress_bubble, self.minify_bubble)
+
+    def _connect_async(self, callback, timeout=None):
         if self.connected:
             callback(None)
             return
+        if self.connecting is not None:
+            # A connection is already in progress; share its result
+            self.connecting.append(callback)
+            return
+        path = self._connect_path()
+        self.connect_pipes()
+        self.reader = loop.reader(self.rpipe, self)
+        self.writer = loop.writer(self.wpipe)
+        self.connecting = [callback]
+        self._handshake(path, timeout)
+
+    def _connect_path(self):
+        """Get the chain of hosts to the new tunnel.
+
+        Raise DepthLimitExceeded if it would be too long.
+
+        """
         try:
             path = sys._chopsticks_path[:]
         except AttributeError:
@@ -487,21 +1325,28 @@ class PipeTunnel(BaseTunnel):
                     ' -> '.join(path)
                 )
             )
+        return path
 
-        self.connect_pipes()
-        self.reader = loop.reader(self.rpipe, self)
-        self.writer = loop.writer(self.wpipe)
+    def _handshake(self, path, timeout=None):
+        """Start the remote agent over the newly connected pipes.
 
+        The callbacks in ``self.connecting`` are called with the result.
+
+        """
         def wrapped_callback(res):
             self.connected = not isinstance(res, ErrorResult)
             if self.connected:
                 # Remote sends a pickle_version in response to OP_START
                 self.pickle_version = min(self.HIGHEST_PICKLE_PROTOCOL, res)
-            callback(res)
+            callbacks = self.connecting or []
+            self.connecting = None
+            for cb in callbacks:
+                cb(res)
         self.callbacks[0] = wrapped_callback
+        self._set_timeout(0, timeout)
 
         self.reader.start()
-        self.writer.write_raw(bubble)
+        self.writer.write_raw(self._bootstrap()[0])
 
         self.write_msg(
             OP_START,
@@ -509,6 +1354,11 @@ class PipeTunnel(BaseTunnel):
             host=self.host,
             path=path,
             depthlimit=chopsticks.DEPTH_LIMIT,
+            workers=self.workers,
+            queue_depth=self.queue_depth,
+            missing=self._new_missing(),
+            module_cache=self.module_cache,
+            pencode_protocol=PENCODE_PROTOCOL,
         )
 
         self.errreader = ioloop.StderrReader(errloop, self.epipe, self.host)
@@ -517,9 +1367,17 @@ class PipeTunnel(BaseTunnel):
     def on_error(self, err):
         err = ErrorResult(err)
         for id in list(self.callbacks):
-            self.callbacks.pop(id)(err)
+            self._pop_callback(id, None)(err)
 
     def _join(self, timeout=5):
+        if not PY2:
+            try:
+                self.proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            return True
+
+        # Python 2's Popen.wait() has no timeout, so we have to poll
         end = time.time() + timeout
         while time.time() < end:
             if self.proc.poll() is not None:
@@ -527,13 +1385,36 @@ class PipeTunnel(BaseTunnel):
             time.sleep(0.01)
         return False
 
-    def close(self):
-        if not self.connected:
+    def _kill(self):
+        """Kill the child process without waiting for it to shut down."""
+        if not self.connected and self.connecting is None:
             return
-        self.wpipe.close()  # Terminate child
-        self.reader.stop()
+        self.reader.close()
         self.writer.stop()
         self._reset()
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.wpipe.close()
+
+    def close(self):
+        # A tunnel that is still connecting has a child process to clean up
+        # too
+        if not self.connected and self.connecting is None:
+            return
+        if self.loop is not loop:
+            # Don't block the asyncio event loop waiting for the child
+            from .aio import close_nowait
+            close_nowait(self)
+            return
+
+        # The reader and writer belong to the loop, which may be using them
+        # in another thread
+        def disconnect(on_done):
+            self._disconnect()
+            on_done(None)
+        run_op(disconnect)
 
         if self._join(timeout=1):
             return
@@ -549,6 +1430,13 @@ class PipeTunnel(BaseTunnel):
         self.proc.kill()
         self._warn('Timeout expired waiting for pipe to close')
 
+    def _disconnect(self):
+        """Stop talking to the child, which terminates it."""
+        self.reader.close()
+        self.writer.stop()
+        self.wpipe.close()
+        self._reset()
+
     def __del__(self):
         self.close()
 
@@ -562,15 +1450,10 @@ class PipeTunnel(BaseTunnel):
 class SubprocessTunnel(PipeTunnel):
     """A tunnel that connects to a subprocess."""
 
-    #: These arguments are used for bootstrapping Python into out remote agent
-    PYTHON_ARGS = [
-        '-usS',
-        '-c',
-        'import sys, os; _bsz = %d ;' % len(bubble) +
-        'inpipe = os.fdopen(os.dup(0), \'rb\', _bsz); ' +
-        '__bubble = sys.stdin.read(_bsz); ' +
-        'exec(compile(__bubble, \'bubble.py\', \'exec\'))'
-    ]
+    #: These arguments are used for bootstrapping Python into our remote agent
+    #: when the bubble is sent uncompressed. If a subclass overrides them,
+    #: the bubble is always sent uncompressed.
+    PYTHON_ARGS = bootstrap(compress=False)[1]
 
     # Paths to the Python 2/3 binary on the remote host
     python2 = '/usr/bin/python2'
@@ -591,9 +1474,14 @@ class SubprocessTunnel(PipeTunnel):
         self.rpipe = self.proc.stdout
         self.epipe = self.proc.stderr
 
+    def _bootstrap(self):
+        if self.PYTHON_ARGS is not SubprocessTunnel.PYTHON_ARGS:
+            return bootstrap(compress=False)[0], self.PYTHON_ARGS
+        return super(SubprocessTunnel, self)._bootstrap()
+
     def cmd_args(self):
         python = self.python2 if PY2 else self.python3
-        return [python] + self.PYTHON_ARGS
+        return [python] + self._bootstrap()[1]
 
 
 class Local(SubprocessTunnel):
@@ -687,24 +1575,131 @@ class SSHTunnel(SubprocessTunnel):
                  not ``ssh`` directly as the root user.
 
     """
+    #: If True, tunnels to the same host, user and port share one SSH
+    #: connection using OpenSSH's ``ControlMaster`` feature, so that only
+    #: the first has to wait for the connection to be set up.
+    control_master = True
+
+    #: How long, in seconds, the shared connection stays open after the last
+    #: tunnel using it is closed, so that it can be reused by later tunnels
+    #: and later runs. If 0, the default, the connection is closed as soon as
+    #: the last tunnel in this process using it is closed. Persistent
+    #: connections are left running in the background, one per host, until
+    #: they expire or :meth:`close_master` is called.
+    control_persist = 0
+
+    # The number of connected tunnels in this process using each control
+    # socket
+    _control_users = {}
+
+    #: The local directory for control sockets. If it does not exist, it is
+    #: created so that only the current user can access it.
+    control_dir = os.path.join('~', '.chopsticks', 'cp')
+
     def __init__(self, host, user=None, port=None, sudo=False):
         self.host = host
         self.user = user
         self.port = port
         self.sudo = sudo
+        # The control socket this tunnel's connection is shared through
+        self.shared_path = None
         super(SubprocessTunnel, self).__init__()
 
-    def cmd_args(self):
+    def control_path(self):
+        """Get the path of the control socket for this tunnel's connection.
+
+        The name is a hash, because socket paths are limited in length.
+
+        """
+        key = '%s@%s:%s' % (self.user or '', self.host, self.port or '')
+        name = sha1(key.encode('utf8')).hexdigest()[:20]
+        return os.path.join(os.path.expanduser(self.control_dir), name)
+
+    def _control_args(self):
+        """Get ssh options to share a connection through the control socket."""
+        if not self.control_master:
+            return []
+        path = self.control_path()
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        # The connection is always handed to a master in the background, so
+        # that it does not depend on the tunnel that opened it staying open
+        persist = '%ds' % max(self.control_persist, 1)
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % path,
+            '-o', 'ControlPersist=%s' % persist,
+        ]
+
+    def _ssh_args(self):
+        """Get the ssh command line up to the remote command."""
         args = ['ssh', '-o', 'PasswordAuthentication=no']
+        args.extend(self._control_args())
         if self.user:
             args.extend(['-l', self.user])
         if self.port:
-            args.extend(['-p', self.port])
+            args.extend(['-p', str(self.port)])
         args.append(self.host)
+        return args
+
+    def cmd_args(self):
+        args = []
         if self.sudo:
             args.append('sudo')
         args.extend(super(SSHTunnel, self).cmd_args())
-        return ['"%s"' % w if ' ' in w else w for w in args]
+        # ssh passes the remote command to a shell
+        remote = ['"%s"' % w if ' ' in w else w for w in args]
+        return self._ssh_args() + remote
+
+    def connect_pipes(self):
+        super(SSHTunnel, self).connect_pipes()
+        if self.control_master and self.shared_path is None:
+            self.shared_path = self.control_path()
+            users = self._control_users
+            users[self.shared_path] = users.get(self.shared_path, 0) + 1
+
+    def _release_master(self):
+        """Stop sharing the connection, closing it if we were the last."""
+        path, self.shared_path = self.shared_path, None
+        if path is None:
+            return
+        users = self._control_users
+        users[path] -= 1
+        if users[path]:
+            return
+        del users[path]
+        if not self.control_persist:
+            # Stop the master accepting new sessions, so that it exits
+            # once sessions from any other process are done with it
+            self._control_cmd('stop')
+
+    def _kill(self):
+        super(SSHTunnel, self)._kill()
+        self._release_master()
+
+    def close(self):
+        super(SSHTunnel, self).close()
+        self._release_master()
+
+    def _control_cmd(self, cmd):
+        """Send a control command to the shared connection's master."""
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.call(
+                ['ssh'] + self._control_args() + ['-O', cmd, self.host],
+                stdout=devnull,
+                stderr=devnull,
+            )
+
+    def close_master(self):
+        """Close the shared SSH connection to this tunnel's host, if any.
+
+        Other tunnels still using the connection are disconnected.
+
+        """
+        if not self.control_master:
+            return
+        self._control_cmd('exit')
 
 
 # An alias, because this is the default tunnel type
@@ -0,0 +1,64 @@
+import sys
+import itertools
+import importlib
+import pytest
+from chopsticks.tunnel import BaseTunnel
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # async/await syntax is a SyntaxError on older Pythons
+    collect_ignore.append('test_aio.py')
+
+
+counter = itertools.count()
+
+
+@pytest.fixture
+def pkg(tmpdir):
+    """Create a package with submodules, importable only by the controller.
+
+    Return the imported package.
+
+    """
+    name = 'testpkg%d' % next(counter)
+    root = tmpdir.mkdir('src').mkdir(name)
+    for i in range(5):
+        root.join('mod%d.py' % i).write('import json\nVALUE = %d\n' % i)
+    root.join('__init__.py').write(
+        'from . import mod0, mod1, mod2, mod3, mod4\n'
+        '\n'
+        'def total():\n'
+        '    return sum(m.VALUE for m in (mod0, mod1, mod2, mod3, mod4))\n'
+    )
+    path = str(tmpdir.join('src'))
+    sys.path.insert(0, path)
+    try:
+        yield importlib.import_module(name)
+    finally:
+        sys.path.remove(path)
+
+
+@pytest.fixture
+def spy(monkeypatch):
+    """Return a function to watch calls to a method of all tunnels.
+
+    ``spy(name, func)`` calls ``func(tunnel, *args, **kwargs)`` before each
+    call to the method `name`.
+
+    """
+    def spy(name, func):
+        method = getattr(BaseTunnel, name)
+
+        def wrapper(self, *args, **kwargs):
+            func(self, *args, **kwargs)
+            return method(self, *args, **kwargs)
+        monkeypatch.setattr(BaseTunnel, name, wrapper)
+    return spy
+
+
+@pytest.fixture
+def requests(spy):
+    """Record the modules that remote hosts request."""
+    reqs = []
+    spy('handle_imp', lambda tunnel, mod: reqs.append(mod))
+    return reqs
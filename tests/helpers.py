@@ -0,0 +1,10 @@
+"""Callables for tests to run on remote hosts."""
+import sys
+import time
+
+
+def sleep_on(host, delay, value):
+    """Sleep for delay seconds if we are running on the given host."""
+    if sys._chopsticks_host == host:
+        time.sleep(delay)
+    return value
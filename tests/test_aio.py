@@ -0,0 +1,195 @@
+"""Tests for the asyncio API."""
+import asyncio
+import os
+import time
+import pytest
+from chopsticks.tunnel import Local, RemoteException, ErrorResult, loop
+from chopsticks.group import Group
+from helpers import sleep_on
+
+
+def run(coro):
+    """Run a coroutine to completion on a new event loop."""
+    aloop = asyncio.new_event_loop()
+    try:
+        return aloop.run_until_complete(coro)
+    finally:
+        # Let closed transports clean up
+        aloop.run_until_complete(asyncio.sleep(0))
+        aloop.close()
+
+
+def test_acall():
+    """We can await a call on a tunnel."""
+    async def main():
+        with Local('aio') as tun:
+            return await tun.acall(len, 'abc')
+    assert run(main()) == 3
+
+
+def test_concurrent():
+    """Concurrent calls on one tunnel run at the same time."""
+    async def main():
+        with Local('aio') as tun:
+            await tun.aconnect()
+            start = time.time()
+            await asyncio.gather(*[
+                tun.acall(time.sleep, 0.5) for _ in range(10)
+            ])
+            return time.time() - start
+    assert run(main()) < 2
+
+
+def test_error():
+    """Remote exceptions are raised as RemoteException."""
+    async def main():
+        with Local('aio') as tun:
+            with pytest.raises(RemoteException):
+                await tun.acall(int, 'x')
+            return await tun.acall(int, '1')
+    assert run(main()) == 1
+
+
+def test_timeout():
+    """Calls accept a timeout."""
+    async def main():
+        with Local('aio') as tun:
+            await tun.aconnect()
+            with pytest.raises(RemoteException):
+                await tun.acall(time.sleep, 2, timeout=0.2)
+    start = time.time()
+    run(main())
+    assert time.time() - start < 2
+
+
+def test_close_nonblocking():
+    """Closing an asyncio tunnel does not wait for the process to exit."""
+    async def main():
+        tun = Local('aio')
+        with pytest.raises(RemoteException):
+            await tun.acall(time.sleep, 2, timeout=0.2)
+        proc = tun.proc
+        start = time.time()
+        tun.close()
+        elapsed = time.time() - start
+        while proc.poll() is None:
+            await asyncio.sleep(0.05)
+        return elapsed
+    assert run(main()) < 0.5
+
+
+def test_aclose():
+    """aclose() waits for the process without blocking the loop."""
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.05)
+
+    async def main():
+        tun = Local('aio')
+        with pytest.raises(RemoteException):
+            await tun.acall(time.sleep, 2, timeout=0.2)
+        proc = tun.proc
+        ticker = asyncio.ensure_future(tick())
+        await tun.aclose()
+        ticker.cancel()
+        assert proc.poll() is not None
+        assert not tun.connected
+    run(main())
+    assert len(ticks) > 5
+
+
+def test_group_aclose():
+    """Groups can be closed from a coroutine."""
+    async def main():
+        group = Group([Local('ac1'), Local('ac2')])
+        await group.acall(len, 'ab')
+        procs = [t.proc for t in group.tunnels]
+        await group.aclose()
+        return [p.poll() for p in procs]
+    assert None not in run(main())
+
+
+def test_blocking_call_rejected():
+    """A tunnel connected on an asyncio loop cannot be used synchronously."""
+    async def main():
+        with Local('aio') as tun:
+            await tun.aconnect()
+            with pytest.raises(RuntimeError):
+                tun.call(len, 'abc')
+    run(main())
+
+
+def test_put_fetch(tmpdir):
+    """Files can be transferred from coroutines."""
+    src = tmpdir.join('src')
+    src.write_binary(os.urandom(100000))
+    remote = str(tmpdir.join('remote'))
+    local = str(tmpdir.join('local'))
+
+    async def main():
+        with Local('aio') as tun:
+            res = await tun.aput(str(src), remote)
+            assert res['size'] == 100000
+            res = await tun.afetch(remote, local)
+            assert res['size'] == 100000
+    run(main())
+    assert tmpdir.join('local').read_binary() == src.read_binary()
+
+
+def test_group_acall():
+    """Groups can call on all hosts from a coroutine."""
+    async def main():
+        group = Group([Local('aio1'), Local('aio2')])
+        try:
+            return await group.acall(str, 1)
+        finally:
+            group.close()
+    assert run(main()) == {'aio1': '1', 'aio2': '1'}
+
+
+def test_group_max_parallel():
+    """Group coroutine methods accept max_parallel."""
+    async def main():
+        group = Group([Local('aio%d' % i) for i in range(4)])
+        try:
+            await group.aconnect()
+            start = time.time()
+            res = await group.acall(time.sleep, 0.5, max_parallel=2)
+            return res, time.time() - start
+        finally:
+            group.close()
+    res, duration = run(main())
+    assert res == {'aio0': None, 'aio1': None, 'aio2': None, 'aio3': None}
+    assert duration >= 1
+
+
+def test_group_stragglers():
+    """Hosts that miss the deadline are given ErrorResults."""
+    async def main():
+        group = Group([Local('fast'), Local('slow')])
+        try:
+            # Warm up, so that remote imports do not count against the timeout
+            await group.acall(sleep_on, 'slow', 0, None)
+            return await group.acall(sleep_on, 'slow', 2, 'done', timeout=0.5)
+        finally:
+            group.close()
+    res = run(main())
+    assert res['fast'] == 'done'
+    assert isinstance(res['slow'], ErrorResult)
+
+
+def test_background_loop():
+    """Tunnels connected synchronously work if the IOLoop is threaded."""
+    loop.start_thread()
+    try:
+        with Local('threaded') as tun:
+            tun.connect()
+
+            async def main():
+                return await tun.acall(len, 'abcd')
+            assert run(main()) == 4
+    finally:
+        loop.stop_thread()
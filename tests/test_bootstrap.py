@@ -0,0 +1,100 @@
+"""Tests for bootstrapping the agent on the remote host."""
+import os
+import sys
+import platform
+import pytest
+from chopsticks.tunnel import Local, SubprocessTunnel, bubble, minify
+
+
+# Relay stdin to a child process in small chunks, as a slow link would
+RELAY = '''
+import os, sys, time, subprocess
+child = subprocess.Popen(sys.argv[1:], stdin=subprocess.PIPE, bufsize=0)
+while True:
+    chunk = os.read(0, 1024)
+    if not chunk:
+        break
+    child.stdin.write(chunk)
+    time.sleep(0.005)
+child.stdin.close()
+sys.exit(child.wait())
+'''
+
+
+class Relayed(Local):
+    """A local tunnel whose input is relayed through another process."""
+
+    def cmd_args(self):
+        return [sys.executable, '-c', RELAY] + super(Relayed, self).cmd_args()
+
+
+#: A Python 2 interpreter to run the agent with, if there is one
+PYTHON2 = os.environ.get('CHOPSTICKS_TEST_PYTHON2', '/usr/bin/python2')
+
+
+class Python2(Local):
+    """A local tunnel to an agent running on Python 2."""
+    python2 = python3 = PYTHON2
+
+
+class CustomArgs(Local):
+    """A local tunnel that overrides the Python arguments."""
+    PYTHON_ARGS = ['-B'] + SubprocessTunnel.PYTHON_ARGS
+
+
+def test_minify():
+    """Minified agent code is smaller and still compiles."""
+    code = minify(bubble)
+    assert len(code) < len(bubble)
+    compile(code, 'bubble.py', 'exec')
+
+
+def test_minify_strings():
+    """Comments and blank lines inside strings are kept."""
+    source = b'x = """\n\n# not a comment\n"""  # comment\n\n\ny = 1\n'
+    assert minify(source) == b'x = """\n\n# not a comment\n"""\ny = 1\n'
+
+
+@pytest.mark.parametrize('tunnel_cls', [Local, Relayed])
+@pytest.mark.parametrize('compress,minify_code', [
+    (False, False),
+    (True, False),
+    (True, True),
+])
+def test_connect(tunnel_cls, compress, minify_code):
+    """Tunnels connect with each bootstrap mode, over a slow link too."""
+    tun = tunnel_cls()
+    tun.compress_bubble = compress
+    tun.minify_bubble = minify_code
+    try:
+        assert tun.call(sum, [1, 2], timeout=20) == 3
+    finally:
+        tun.close()
+
+
+@pytest.mark.skipif(
+    not os.path.exists(PYTHON2),
+    reason='Python 2 is not available'
+)
+def test_python2_agent():
+    """The agent can reply from Python 2, which has no os.writev()."""
+    tun = Python2()
+    try:
+        # Connect first, as calls sent along with the handshake are pickled
+        # for the controller's own major version
+        tun.connect(timeout=20)
+        assert tun.call(platform.python_version, timeout=20).startswith('2.')
+    finally:
+        tun.close()
+
+
+def dont_write_bytecode():
+    """Return whether the interpreter was started with -B."""
+    return sys.dont_write_bytecode
+
+
+def test_python_args():
+    """Overridden PYTHON_ARGS are used, with the bubble uncompressed."""
+    with CustomArgs() as tun:
+        assert tun.cmd_args()[1:] == CustomArgs.PYTHON_ARGS
+        assert tun.call(dont_write_bytecode) is True
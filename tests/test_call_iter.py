@@ -0,0 +1,49 @@
+"""Tests for streaming results from a Group as they arrive."""
+import sys
+import time
+from chopsticks.tunnel import Local
+from chopsticks.group import Group
+
+
+def delayed_host():
+    """Return the hostname after a delay depending on the host."""
+    host = sys._chopsticks_host
+    time.sleep({'fast': 0, 'slow': 0.5}[host])
+    return host
+
+
+grp = Group([Local('slow'), Local('fast')])
+
+
+def setup_module():
+    """Connect the group and warm up imports."""
+    grp.call(time.time)
+
+
+def teardown_module():
+    """Disconnect the group."""
+    grp.close()
+
+
+def test_call_iter_order():
+    """Results are yielded in the order they arrive."""
+    res = list(grp.call_iter(delayed_host))
+    assert res == [('fast', 'fast'), ('slow', 'slow')]
+
+
+def test_call_iter_nested():
+    """We can perform other operations while iterating."""
+    fast = grp.tunnels[1]
+    seen = []
+    for host, res in grp.call_iter(delayed_host):
+        seen.append(host)
+        assert fast.call(delayed_host) == 'fast'
+    assert sorted(seen) == ['fast', 'slow']
+
+
+def test_call_iter_abandon():
+    """Abandoning iteration does not disturb later operations."""
+    it = grp.call_iter(delayed_host)
+    assert next(it) == ('fast', 'fast')
+    it.close()
+    assert dict(grp.call(delayed_host)) == {'fast': 'fast', 'slow': 'slow'}
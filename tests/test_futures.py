@@ -0,0 +1,70 @@
+"""Tests for pipelining calls over a tunnel with futures."""
+import time
+import pytest
+from chopsticks.tunnel import (
+    Local, RemoteException, WaitTimeout, gather, wait
+)
+
+
+tunnel = Local()
+
+
+def teardown_module():
+    """Disconnect the tunnel."""
+    tunnel.close()
+
+
+def test_submit():
+    """We can submit a call and wait for its result."""
+    f = tunnel.submit(len, 'abc')
+    assert f.result() == 3
+    assert f.done()
+
+
+def test_pipelined():
+    """Submitted calls run concurrently on the remote host."""
+    start = time.time()
+    futures = [tunnel.submit(time.sleep, 0.5) for _ in range(10)]
+    assert gather(futures) == [None] * 10
+    assert time.time() - start < 2
+
+
+def test_gather_order():
+    """gather() returns results in the order of the futures."""
+    futures = [tunnel.submit(str, i) for i in range(50)]
+    assert gather(futures) == [str(i) for i in range(50)]
+
+
+def test_error():
+    """A failed call raises RemoteException when its result is requested."""
+    f = tunnel.submit(int, 'x')
+    with pytest.raises(RemoteException):
+        f.result()
+
+
+def test_wait_timeout():
+    """wait() can return before all futures are done."""
+    f = tunnel.submit(time.sleep, 0.5)
+    wait([f], timeout=0.05)
+    assert not f.done()
+    wait([f])
+    assert f.done()
+
+
+def test_result_timeout():
+    """Timing out waiting for a result leaves the call pending."""
+    f = tunnel.submit(time.sleep, 0.5)
+    with pytest.raises(WaitTimeout) as excinfo:
+        f.result(timeout=0.05)
+    assert 'localhost' in str(excinfo.value)
+    assert not f.done()
+    assert f.result() is None
+
+
+def test_done_callback():
+    """Callbacks are called when a future is done."""
+    done = []
+    f = tunnel.submit(len, 'ab')
+    f.add_done_callback(done.append)
+    f.result()
+    assert done == [f]
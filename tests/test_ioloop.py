@@ -0,0 +1,276 @@
+"""Tests for the IOLoop and its polling backends."""
+import os
+import time
+import resource
+
+import pytest
+from chopsticks.ioloop import (
+    IOLoop, BACKENDS, MessageReader, HEADER, MSG_BYTES, MSG_PENCODE
+)
+from chopsticks.pencode import pencode, LAZY_BYTES_MIN
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def loop(request):
+    """An IOLoop for each available backend."""
+    return IOLoop(request.param)
+
+
+def test_unknown_backend():
+    """Constructing a loop with an unknown backend is an error."""
+    with pytest.raises(ValueError):
+        IOLoop('nonexistent')
+
+
+def test_read_write(loop):
+    """The loop dispatches read and write callbacks."""
+    r, w = os.pipe()
+    received = []
+
+    def on_write():
+        os.write(w, b'hello')
+        loop.abort_write(w)
+
+    def on_read():
+        received.append(os.read(r, 512))
+        loop.stop()
+
+    loop.want_write(w, on_write)
+    loop.want_read(r, on_read)
+    loop.run()
+    assert received == [b'hello']
+    os.close(r)
+    os.close(w)
+
+
+def test_persistent_callbacks(loop):
+    """Callbacks stay registered until aborted."""
+    r, w = os.pipe()
+    received = []
+
+    def on_read():
+        received.append(os.read(r, 1))
+        if len(received) == 3:
+            loop.abort_read(r)
+
+    os.write(w, b'abc')
+    loop.want_read(r, on_read)
+    loop.run()
+    assert received == [b'a', b'b', b'c']
+    os.close(r)
+    os.close(w)
+
+
+def test_reused_fd(loop):
+    """An fd closed and reopened between polls is registered afresh."""
+    r, w = os.pipe()
+    writes = []
+
+    def on_write():
+        writes.append(w)
+        loop.abort_write(w)
+        loop.stop()
+
+    loop.want_write(w, on_write)
+    loop.run()
+
+    # Close the fd and reuse its number before the loop has caught up
+    r2, w2 = os.pipe()
+    os.close(w)
+    assert os.dup(w2) == w
+    os.close(w2)
+    os.close(r)
+    r = r2
+
+    loop.want_write(w, on_write)
+    loop.call_later(1, loop.stop)
+    loop.run()
+    assert writes == [w, w]
+    os.close(r)
+    os.close(w)
+
+
+def test_no_wakeup_from_loop_thread(loop):
+    """Changes made from within callbacks do not write the wakeup pipe."""
+    r, w = os.pipe()
+    writes = []
+    loop.os_write = lambda fd, data: writes.append(fd)
+
+    def on_write():
+        os.write(w, b'x')
+        loop.abort_write(w)
+        loop.want_read(r, on_read)
+
+    def on_read():
+        os.read(r, 1)
+        loop.abort_read(r)
+
+    loop.want_write(w, on_write)
+    loop.run()
+    assert writes == []
+    os.close(r)
+    os.close(w)
+
+
+def test_high_fd():
+    """The selectors backend can poll fds above FD_SETSIZE."""
+    if 'selectors' not in BACKENDS:
+        pytest.skip('selectors not available')
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= 2048:
+        pytest.skip('fd limit too low')
+    loop = IOLoop('selectors')
+    r, w = os.pipe()
+    high = 2000
+    os.dup2(r, high)
+    os.write(w, b'x')
+    received = []
+
+    def on_read():
+        received.append(os.read(high, 1))
+        loop.stop()
+
+    loop.want_read(high, on_read)
+    loop.run()
+    assert received == [b'x']
+    for fd in (r, w, high):
+        os.close(fd)
+
+
+class Receiver:
+    """A stand-in for a tunnel, which collects messages from a reader."""
+
+    def __init__(self, loop, expected):
+        self.loop = loop
+        self.expected = expected
+        self.messages = []
+
+    def on_message(self, msg):
+        op, req_id, data = msg
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.messages.append((op, req_id, data))
+        if len(self.messages) == self.expected:
+            self.loop.stop()
+
+    def on_error(self, err):
+        self.loop.stop(err)
+
+
+def test_reader_many_frames(loop):
+    """A reader dispatches several frames received in one read."""
+    r, w = os.pipe()
+    recv = Receiver(loop, 3)
+    reader = loop.reader(r, recv)
+    os.write(w, b''.join([
+        HEADER.pack(3, 1, 5, MSG_BYTES) + b'abc',
+        HEADER.pack(0, 2, 5, MSG_BYTES),
+        HEADER.pack(len(pencode({'x': 1})), 3, 1, MSG_PENCODE) +
+        pencode({'x': 1}),
+    ]))
+    reader.start()
+    assert loop.run() is None
+    assert recv.messages == [
+        (5, 1, b'abc'),
+        (5, 2, b''),
+        (1, 3, {'x': 1}),
+    ]
+    reader.stop()
+    os.close(r)
+    os.close(w)
+
+
+def test_reader_large_frame(loop):
+    """A reader can receive a frame larger than its buffer."""
+    r, w = os.pipe()
+    recv = Receiver(loop, 1)
+    reader = loop.reader(r, recv)
+    writer = loop.writer(w)
+    payload = os.urandom(MessageReader.BUFSIZE * 3 + 17)
+    writer.write(5, 1, payload)
+    reader.start()
+    assert loop.run() is None
+    assert recv.messages == [(5, 1, payload)]
+    reader.stop()
+    os.close(r)
+    os.close(w)
+
+
+def test_reader_lazy_bytes(loop):
+    """Large bytes values passed as views stay valid as more is received."""
+    r, w = os.pipe()
+    recv = Receiver(loop, 4)
+    recv.lazy_bytes = True
+    reader = loop.reader(r, recv)
+    writer = loop.writer(w)
+    payloads = [os.urandom(LAZY_BYTES_MIN + i) for i in range(4)]
+    for i, payload in enumerate(payloads):
+        writer.write(1, i, {'ret': payload})
+    reader.start()
+    assert loop.run() is None
+    for (op, req_id, data), payload in zip(recv.messages, payloads):
+        assert isinstance(data['ret'], memoryview)
+        assert data['ret'] == payload
+    reader.stop()
+    os.close(r)
+    os.close(w)
+
+
+def test_writer_order(loop):
+    """Queued messages and iterators are written in order."""
+    r, w = os.pipe()
+    recv = Receiver(loop, 6)
+    reader = loop.reader(r, recv)
+    writer = loop.writer(w)
+    writer.write(5, 1, b'a')
+    writer.write_iter(iter([(5, 2, b'b'), (5, 3, b'c' * 100000)]))
+    writer.write(5, 4, {'d': 4})
+    writer.write_iter(iter([]))
+    writer.write_iter(iter([(5, 5, b'e')]))
+    writer.write(5, 6, b'f')
+    reader.start()
+    assert loop.run() is None
+    assert recv.messages == [
+        (5, 1, b'a'),
+        (5, 2, b'b'),
+        (5, 3, b'c' * 100000),
+        (5, 4, {'d': 4}),
+        (5, 5, b'e'),
+        (5, 6, b'f'),
+    ]
+    reader.stop()
+    os.close(r)
+    os.close(w)
+
+
+def test_call_later_order(loop):
+    """Timers fire in order of their deadlines."""
+    fired = []
+    loop.call_later(0.03, fired.append, 3)
+    loop.call_later(0.01, fired.append, 1)
+    loop.call_later(0.02, fired.append, 2)
+    loop.run()
+    assert fired == [1, 2, 3]
+
+
+def test_cancel_timer(loop):
+    """Cancelled timers do not fire or keep the loop running."""
+    fired = []
+    t = loop.call_later(10, fired.append, 'cancelled')
+    loop.call_later(0.01, fired.append, 'fired')
+    t.cancel()
+    start = time.time()
+    loop.run()
+    assert time.time() - start < 1
+    assert fired == ['fired']
+
+
+def test_timer_stops_loop(loop):
+    """A timer can interrupt a loop waiting on an idle fd."""
+    r, w = os.pipe()
+    loop.want_read(r, lambda: None)
+    loop.call_later(0.01, loop.stop, 'timed out')
+    assert loop.run() == 'timed out'
+    loop.abort_read(r)
+    os.close(r)
+    os.close(w)
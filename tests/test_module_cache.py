@@ -0,0 +1,62 @@
+"""Tests for the remote on-disk module cache."""
+import os
+import pytest
+from chopsticks.tunnel import Local, OP_IMP
+
+
+@pytest.fixture
+def sources(spy):
+    """Record whether the source of each module sent was included."""
+    sent = {}
+
+    def record(tunnel, op, req_id, data=None, **kwargs):
+        if op == OP_IMP:
+            imp = data or kwargs
+            for m in imp.get('batch', ()):
+                sent[m[0]] = m[4] is not None
+            if 'mod' in imp:
+                sent[imp['mod']] = imp['source'] is not None
+    spy('write_msg', record)
+    return sent
+
+
+def call_total(pkg, cache_dir, prefetch=True):
+    """Call pkg.total() over a tunnel using the cache dir."""
+    with Local() as tun:
+        tun.module_cache = cache_dir
+        tun.prefetch_imports = prefetch
+        tun.connect()
+        return tun.call(pkg.total)
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_cached(pkg, sources, tmpdir, prefetch):
+    """Sources are not sent again to a host that has them cached."""
+    cache_dir = str(tmpdir.join('cache'))
+    assert call_total(pkg, cache_dir, prefetch) == 10
+    assert sources and all(sources.values())
+    sources.clear()
+    assert call_total(pkg, cache_dir, prefetch) == 10
+    assert sources and not any(sources.values())
+
+
+def test_lost(pkg, sources, tmpdir):
+    """Sources are sent again if the cached copy cannot be read."""
+    cache_dir = tmpdir.join('cache')
+    assert call_total(pkg, str(cache_dir)) == 10
+    with Local() as tun:
+        tun.module_cache = str(cache_dir)
+        tun.connect()
+        for f in cache_dir.listdir():
+            f.remove()
+        assert tun.call(pkg.total) == 10
+
+
+def test_not_private(pkg, sources, tmpdir):
+    """A cache directory others can write to is not used."""
+    cache_dir = tmpdir.mkdir('cache')
+    os.chmod(str(cache_dir), 0o777)
+    assert call_total(pkg, str(cache_dir)) == 10
+    assert call_total(pkg, str(cache_dir)) == 10
+    assert all(sources.values())
+    assert not cache_dir.listdir()
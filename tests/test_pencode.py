@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 """Tests for Python-friendly binary encoding."""
+import io
 import math
+import sys
 
 from hypothesis import example, given, strategies
 import pytest
-from chopsticks.pencode import pencode, pdecode
+from chopsticks.pencode import (
+    pencode, pdecode, pencode_into, pencode_to, HIGHEST_PROTOCOL,
+    LAZY_BYTES_MIN, FLUSH_FRAGMENTS
+)
+from chopsticks.tunnel import Local
 
 try:
     # Added in Python 3.5+
@@ -49,9 +55,9 @@ mutables = strategies.recursive(
     ),
 )
 
-def assert_roundtrip(obj):
+def assert_roundtrip(obj, protocol=1):
     """Assert that we can successfully round-trip the given object."""
-    buf = pencode(obj)
+    buf = pencode(obj, protocol)
     assert isinstance(buf, bytes)
     obj2 = pdecode(buf)
 
@@ -178,3 +184,189 @@ def test_roundtrip_start():
         'path': [host],
         'depthlimit': 2
     })
+
+
+@given(strategies.integers())
+@example(-(1 << 63))
+@example((1 << 63) - 1)
+@example(1 << 63)
+@example(-8193)
+def test_roundtrip_int_v2(i):
+    """We can round-trip ints of any size with protocol 2."""
+    assert_roundtrip(i, protocol=2)
+
+
+@given(strategies.floats())
+def test_roundtrip_float_v2(f):
+    """We can round-trip floats with protocol 2."""
+    assert_roundtrip(f, protocol=2)
+
+
+@given(strategies.lists(mutables | immutables))
+def test_roundtrip_list_v2(l):
+    """We can round-trip structures with protocol 2."""
+    assert_roundtrip(l, protocol=2)
+
+
+@given(strategies.lists(mutables | immutables))
+def test_roundtrip_list_v3(l):
+    """We can round-trip structures with protocol 3."""
+    assert_roundtrip(l, protocol=3)
+
+
+def test_roundtrip_self_referential_v3():
+    """We can round-trip a self-referential structure with protocol 3."""
+    a = []
+    a.append(a)
+    b = pdecode(pencode(a, protocol=3))
+    assert b[0] is b
+
+
+def test_backrefs_v3():
+    """With protocol 3, shared containers and strings are referenced."""
+    foo = u'foo' * 10
+    shared = [1.5, 100000]
+    obj = [shared, foo, 1.5, 100000, shared, foo, {u'x': shared}]
+    buf = pencode(obj, protocol=3)
+    assert buf.count(b'R') == 3
+    obj2 = pdecode(buf)
+    assert obj2 == obj
+    assert obj2[0] is obj2[4] is obj2[6][u'x']
+    assert obj2[1] is obj2[5]
+
+
+@pytest.mark.parametrize('protocol', [1, 3])
+def test_roundtrip_deep(protocol):
+    """We can round-trip structures nested deeper than the recursion limit."""
+    obj = inner = []
+    for _ in range(sys.getrecursionlimit() * 10):
+        inner.append([])
+        inner.append({u'parent': (inner,)})
+        inner = inner[0]
+    obj2 = pdecode(pencode(obj, protocol))
+    depth = 0
+    while obj2:
+        obj2 = obj2[0]
+        depth += 1
+    assert depth == sys.getrecursionlimit() * 10
+
+
+@pytest.mark.parametrize('obj', [
+    [1.5, -2.5] * 100,
+    list(range(-64, 64)),
+    (1 << 40, -(1 << 40)),
+    set(range(50)),
+    [1, 1 << 40, 2.5],
+])
+@pytest.mark.parametrize('protocol', [1, 2, 3])
+def test_roundtrip_numbers(obj, protocol):
+    """We can round-trip sequences of numbers, which may be decoded in bulk."""
+    assert_roundtrip(obj, protocol)
+
+
+def test_decode_long_varints():
+    """Varints longer than a byte are not decoded in bulk."""
+    assert pdecode(b'P\x03l\x00\x00\x00\x02v\x80vv\x02') == [7552, 1]
+
+
+def test_decode_buffer():
+    """We can decode from a bytearray or memoryview."""
+    obj = [u'h\xe9llo', b'bytes', (1, 2.5), {u'x': [None]}]
+    buf = pencode(obj, protocol=3)
+    assert pdecode(bytearray(buf)) == obj
+    assert pdecode(memoryview(buf)) == obj
+
+
+@pytest.mark.parametrize('cls', [bytes, bytearray])
+def test_lazy_bytes(cls):
+    """Large bytes values can be decoded as views of the buffer."""
+    large = b'x' * LAZY_BYTES_MIN
+    obj = [large, b'small', large]
+    buf = cls(pencode(obj))
+    assert [type(v) for v in pdecode(buf)] == [bytes] * 3
+    obj2 = pdecode(buf, lazy_bytes=True)
+    assert obj2 == obj
+    assert [type(v) for v in obj2] == [memoryview, bytes, memoryview]
+    assert obj2[0].obj is memoryview(buf).obj
+
+
+LARGE = {
+    u'rows': [{u'id': i, u'name': u'row%d' % i} for i in range(2000)],
+    u'ints': list(range(FLUSH_FRAGMENTS * 3)),
+    u'names': [u'n%d' % i for i in range(FLUSH_FRAGMENTS * 3)],
+}
+
+
+@pytest.mark.parametrize('protocol', [1, 3])
+def test_pencode_into(protocol):
+    """We can encode onto the end of a bytearray."""
+    buf = bytearray(b'header')
+    size = pencode_into(LARGE, buf, protocol)
+    assert bytes(buf[6:]) == pencode(LARGE, protocol)
+    assert size == len(buf) - 6
+    assert pdecode(memoryview(buf)[6:]) == LARGE
+
+
+class RecordingFile(io.BytesIO):
+    """A file that records how many times it was written to."""
+    writes = 0
+    longest = 0  # the most fragments passed in one call
+
+    def writelines(self, lines):
+        self.writes += 1
+        self.longest = max(self.longest, len(lines))
+        super(RecordingFile, self).writelines(lines)
+
+
+@pytest.mark.parametrize('protocol', [1, 3])
+def test_pencode_to(protocol):
+    """We can encode to a file, in several chunks."""
+    f = RecordingFile()
+    size = pencode_to(LARGE, f, protocol)
+    assert f.getvalue() == pencode(LARGE, protocol)
+    assert size == len(f.getvalue())
+    assert f.writes > 3
+
+
+@pytest.mark.parametrize('obj', [
+    {u'k%d' % i: i for i in range(FLUSH_FRAGMENTS * 10)},
+    [u'x', 1, 2.5] * FLUSH_FRAGMENTS * 3,
+], ids=['dict', 'list'])
+def test_flush_flat(obj):
+    """Output is flushed regularly within large flat containers."""
+    f = RecordingFile()
+    pencode_to(obj, f, 3)
+    assert f.getvalue() == pencode(obj, 3)
+    assert f.writes > 3
+    assert f.longest <= 4 * FLUSH_FRAGMENTS
+
+
+def test_small_ints_v2():
+    """Small ints are encoded compactly with protocol 2."""
+    assert pencode(5, protocol=2) == b'v\x0a'
+    assert pencode(-5, protocol=2) == b'v\x09'
+    assert len(pencode(1000, protocol=2)) == 9
+
+
+def test_unsupported_protocol():
+    """An exception is raised if a protocol is not supported."""
+    with pytest.raises(ValueError):
+        pencode(1, protocol=99)
+
+
+def test_protocol_negotiated():
+    """Tunnels agree to use the highest protocol in the handshake."""
+    with Local() as tun:
+        assert tun.call(sum, [1.5, 2]) == 3.5
+        assert tun.writer.pencode_protocol == HIGHEST_PROTOCOL
+        assert tun.call(sum, [1.5, 2]) == 3.5
+
+
+def test_tunnel_lazy_bytes():
+    """Tunnels can return large bytes results as views."""
+    with Local() as tun:
+        tun.lazy_bytes = True
+        res = tun.call(bytes, LAZY_BYTES_MIN)
+        assert isinstance(res, memoryview)
+        assert res == bytes(LAZY_BYTES_MIN)
+        assert tun.call(bytes, 10) == bytes(10)
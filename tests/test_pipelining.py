@@ -0,0 +1,75 @@
+"""Tests for sending the first operation along with the handshake."""
+from threading import Lock
+import pytest
+from chopsticks.tunnel import Local, RemoteException, OP_CALL
+from chopsticks.group import Group
+
+
+class Broken(Local):
+    """A tunnel to a process that exits at once."""
+    python2 = python3 = 'false'
+
+
+@pytest.fixture
+def sent(spy):
+    """Record the opcodes written, and whether the tunnel was connected."""
+    sent = []
+    spy(
+        'write_msg',
+        lambda tunnel, op, *args, **kwargs: sent.append((op, tunnel.connected))
+    )
+    return sent
+
+
+def test_call_pipelined(sent):
+    """A call on a new tunnel is sent before the handshake completes."""
+    with Local() as tun:
+        assert tun.call(sum, [1, 2]) == 3
+        assert tun.connected
+        assert (OP_CALL, False) in sent
+        del sent[:]
+        assert tun.call(sum, [3, 4]) == 7
+        assert (OP_CALL, True) in sent
+
+
+def test_group_pipelined(sent):
+    """Group calls are sent with the handshake too."""
+    group = Group([Local('pipe1'), Local('pipe2')])
+    try:
+        assert dict(group.call(sum, [1, 2])) == {'pipe1': 3, 'pipe2': 3}
+        assert sent.count((OP_CALL, False)) == 2
+    finally:
+        group.close()
+
+
+def test_connect_error():
+    """The call fails with a connection error if the tunnel can't connect."""
+    tun = Broken()
+    with pytest.raises(RemoteException):
+        tun.call(sum, [1, 2], timeout=10)
+    assert not tun.connected
+
+
+def test_group_connect_error():
+    """Connection errors from pipelined calls are recorded in the group."""
+    group = Group([Local('good'), Broken('broken')])
+    try:
+        res = group.call(sum, [1, 2], timeout=10)
+        assert res['good'] == 3
+        assert 'broken' in dict(res.failures())
+        assert list(group.connection_errors) == ['broken']
+        assert dict(group.call(sum, [3, 4]).successful()) == {'good': 7}
+    finally:
+        group.close()
+
+
+def test_unpicklable_call():
+    """A call that cannot be sent does not leave the tunnel half-open."""
+    tun = Local()
+    with pytest.raises(TypeError):
+        tun.call(len, Lock())
+    assert tun.connecting is None
+    assert not tun.callbacks
+    assert tun.proc.poll() is not None
+    assert tun.call(sum, [1, 2]) == 3
+    tun.close()
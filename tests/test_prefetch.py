@@ -0,0 +1,73 @@
+"""Tests for sending modules to remote hosts ahead of calls."""
+from threading import current_thread
+from chopsticks import tunnel
+from chopsticks.tunnel import Local, loop
+from chopsticks.group import Group
+from chopsticks.prefetch import import_closure
+
+
+def test_import_closure(pkg):
+    """The closure contains the package's modules but not the stdlib."""
+    name = pkg.__name__
+    assert import_closure([name]) == set(
+        [name] + ['%s.mod%d' % (name, i) for i in range(5)]
+    )
+
+
+def test_closure_missing():
+    """Modules that cannot be found have an empty closure."""
+    assert import_closure(['chopsticks_no_such_module']) == set()
+
+
+def test_call_prefetches(pkg, requests):
+    """Calling a function sends its module's imports ahead of the call."""
+    with Local() as tun:
+        assert tun.call(pkg.total) == 10
+    assert not [r for r in requests if str(r).startswith(pkg.__name__)]
+
+
+def test_prefetch_disabled(pkg, requests):
+    """With prefetching disabled, modules are requested one at a time."""
+    with Local() as tun:
+        tun.prefetch_imports = False
+        assert tun.call(pkg.total) == 10
+    assert len([r for r in requests if str(r).startswith(pkg.__name__)]) == 6
+
+
+def test_group_preload(pkg, requests):
+    """Modules preloaded into a group are not requested by calls."""
+    group = Group([Local('preload1'), Local('preload2')])
+    try:
+        for t in group.tunnels:
+            t.prefetch_imports = False
+        group.preload([pkg.__name__])
+        for t in group.tunnels:
+            assert not t.writer.queue
+        results = group.call(pkg.total)
+        results.raise_failures()
+        assert dict(results) == {'preload1': 10, 'preload2': 10}
+    finally:
+        group.close()
+    assert not [r for r in requests if str(r).startswith(pkg.__name__)]
+
+
+def test_prefetch_off_loop(pkg, monkeypatch):
+    """Imports are found by the calling thread rather than the loop."""
+    threads = []
+
+    def closure(modules):
+        threads.append(current_thread())
+        return import_closure(modules)
+    monkeypatch.setattr(tunnel, 'import_closure', closure)
+    loop.start_thread()
+    try:
+        group = Group([Local('offloop1'), Local('offloop2')])
+        with group:
+            assert group.tunnels[0].call(pkg.total) == 10
+            assert group.tunnels[0].submit(pkg.total).result() == 10
+            assert dict(group.call(pkg.total)) == {
+                'offloop1': 10, 'offloop2': 10
+            }
+    finally:
+        loop.stop_thread()
+    assert threads == [current_thread()] * 3
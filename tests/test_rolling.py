@@ -0,0 +1,46 @@
+"""Tests for bounded-concurrency operations on groups."""
+import time
+from chopsticks.tunnel import Local
+from chopsticks.group import Group
+
+
+def hosts(n):
+    """Construct a list of n Local tunnels."""
+    return [Local('local%d' % i) for i in range(n)]
+
+
+def test_max_parallel_call():
+    """With max_parallel, hosts are operated on in a sliding window."""
+    grp = Group(hosts(4))
+    with grp:
+        start = time.time()
+        res = grp.call(time.sleep, 0.3, max_parallel=2)
+        duration = time.time() - start
+    assert dict(res) == dict.fromkeys(res, None)
+    assert len(res) == 4
+    assert 0.6 <= duration < 1.2
+
+
+def test_max_parallel_connects():
+    """With max_parallel, tunnels are connected as they are admitted."""
+    grp = Group(hosts(3), max_parallel=1)
+    try:
+        res = grp.call(time.time)
+        assert len(res) == 3
+        assert all(t.connected for t in grp.tunnels)
+    finally:
+        grp.close()
+
+
+def test_batches():
+    """A group can be split into batches."""
+    grp = Group(hosts(5))
+    batches = [
+        sorted(t.host for t in b.tunnels)
+        for b in grp.batches(2)
+    ]
+    assert batches == [
+        ['local0', 'local1'],
+        ['local2', 'local3'],
+        ['local4'],
+    ]
@@ -0,0 +1,99 @@
+"""Tests for the controller's cache of module sources."""
+import os
+import sys
+from chopsticks.tunnel import SourceCache, Local, source_cache
+
+
+def imp(source):
+    """Construct an OP_IMP response for source."""
+    return dict(
+        mod='mod', exists=True, is_pkg=False, file='mod.py', source=source
+    )
+
+
+def test_hit(tmpdir):
+    """An unchanged file is served from the cache."""
+    cache = SourceCache()
+    path = str(tmpdir.join('mod.py'))
+    with open(path, 'w') as f:
+        f.write('x = 1\n')
+    assert cache.get('mod') is None
+    cache.put('mod', path, imp('x = 1\n'))
+    assert cache.get('mod') == imp('x = 1\n')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_changed(tmpdir):
+    """An entry is invalidated when its file changes."""
+    cache = SourceCache()
+    path = str(tmpdir.join('mod.py'))
+    with open(path, 'w') as f:
+        f.write('x = 1\n')
+    cache.put('mod', path, imp('x = 1\n'))
+    with open(path, 'w') as f:
+        f.write('x = 10\n')
+    assert cache.get('mod') is None
+    assert len(cache) == 0
+
+
+def test_deleted(tmpdir):
+    """An entry is invalidated when its file is removed."""
+    cache = SourceCache()
+    path = str(tmpdir.join('mod.py'))
+    with open(path, 'w') as f:
+        f.write('x = 1\n')
+    cache.put('mod', path, imp('x = 1\n'))
+    os.unlink(path)
+    assert cache.get('mod') is None
+
+
+def test_evict(tmpdir):
+    """The least recently used entries are evicted beyond maxsize."""
+    cache = SourceCache(maxsize=2)
+    path = str(tmpdir.join('mod.py'))
+    with open(path, 'w') as f:
+        f.write('x = 1\n')
+    for key in 'abc':
+        cache.put(key, path, imp(key))
+        cache.get('a')
+    assert list(cache.entries) == ['c', 'a']
+
+
+def test_shared():
+    """Modules served to one tunnel are served to others from the cache."""
+    source_cache.clear()
+    for name in ('cache1', 'cache2'):
+        with Local(name) as tun:
+            tun.connect()
+            tun.handle_imp('chopsticks.facts')
+    assert source_cache.hits >= 1
+    assert 'chopsticks.facts' in source_cache.entries
+
+
+def test_missing(monkeypatch):
+    """Missing modules are remembered until sys.path changes."""
+    cache = SourceCache()
+    cache.put_missing('nosuchmod', imp(''))
+    assert cache.missing_names() == {'nosuchmod'}
+    assert cache.get('nosuchmod') == imp('')
+    monkeypatch.setattr('sys.path', ['/nonexistent'] + sys.path)
+    assert cache.get('nosuchmod') is None
+    assert cache.missing_names() == set()
+
+
+def try_import(name):
+    """Return True if the module name can be imported."""
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def test_missing_sent(requests):
+    """Remote hosts are told about modules that other hosts missed."""
+    source_cache.clear()
+    for name in ('missing1', 'missing2'):
+        with Local(name) as tun:
+            assert tun.call(try_import, 'chopsticks_no_such_mod') is False
+    assert requests.count('chopsticks_no_such_mod') == 1
@@ -0,0 +1,113 @@
+"""Tests for the command lines used by SSH tunnels."""
+import os
+import sys
+import stat
+from chopsticks.tunnel import SSHTunnel
+
+# An ssh that runs the remote command locally, and logs control commands
+STUB_SSH = '''#!%s
+import os, sys
+args = sys.argv[1:]
+if '-O' in args:
+    with open(os.environ['SSH_STUB_LOG'], 'a') as f:
+        f.write(args[args.index('-O') + 1] + '\\n')
+    sys.exit(0)
+while args[0].startswith('-'):
+    args = args[2:]
+os.execvp('sh', ['sh', '-c', ' '.join(args[1:])])
+'''
+
+
+def make_tunnel(tmpdir, *args, **kwargs):
+    """Construct an SSHTunnel with its control sockets under tmpdir."""
+    tun = SSHTunnel(*args, **kwargs)
+    tun.control_dir = str(tmpdir.join('cp'))
+    return tun
+
+
+def option(args, name):
+    """Get the value of the ssh -o option name in args."""
+    for i, a in enumerate(args):
+        if a == '-o' and args[i + 1].startswith(name + '='):
+            return args[i + 1].split('=', 1)[1]
+
+
+def test_control_master(tmpdir):
+    """SSH connections are shared through a private control socket."""
+    args = make_tunnel(tmpdir, 'example.com').cmd_args()
+    assert option(args, 'ControlMaster') == 'auto'
+    assert option(args, 'ControlPersist') == '1s'
+    path = option(args, 'ControlPath')
+    assert os.path.dirname(path) == str(tmpdir.join('cp'))
+    mode = stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode)
+    assert mode == 0o700
+
+
+def test_shared_with_sudo(tmpdir):
+    """Tunnels to the same host as the same user share a connection."""
+    plain = make_tunnel(tmpdir, 'example.com', user='deploy')
+    sudo = make_tunnel(tmpdir, 'example.com', user='deploy', sudo=True)
+    other = make_tunnel(tmpdir, 'example.com', user='admin')
+    assert plain.control_path() == sudo.control_path()
+    assert plain.control_path() != other.control_path()
+    assert 'sudo' in sudo.cmd_args()
+
+
+def test_persist(tmpdir):
+    """The shared connection can be kept open after the tunnels close."""
+    tun = make_tunnel(tmpdir, 'example.com')
+    tun.control_persist = 60
+    assert option(tun.cmd_args(), 'ControlPersist') == '60s'
+
+
+def test_disabled(tmpdir):
+    """Connection sharing can be turned off."""
+    tun = make_tunnel(tmpdir, 'example.com', port=2222)
+    tun.control_master = False
+    args = tun.cmd_args()
+    assert option(args, 'ControlMaster') is None
+    assert args[args.index('-p') + 1] == '2222'
+    assert not tmpdir.join('cp').check()
+
+
+def stub_ssh(tmpdir, monkeypatch):
+    """Put a stub ssh on the PATH; return the path of its control log."""
+    bindir = tmpdir.mkdir('bin')
+    ssh = bindir.join('ssh')
+    ssh.write(STUB_SSH % sys.executable)
+    ssh.chmod(0o755)
+    log = tmpdir.join('control.log')
+    log.write('')
+    monkeypatch.setenv('PATH', str(bindir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('SSH_STUB_LOG', str(log))
+    return log
+
+
+def test_close_shared(tmpdir, monkeypatch):
+    """The shared connection is closed along with the last tunnel using it."""
+    log = stub_ssh(tmpdir, monkeypatch)
+    first = make_tunnel(tmpdir, 'example.com')
+    second = make_tunnel(tmpdir, 'example.com')
+    try:
+        assert first.call(sum, [1, 2], timeout=20) == 3
+        assert second.call(sum, [3, 4], timeout=20) == 7
+        first.close()
+        assert log.read() == ''
+        assert second.call(sum, [5, 6], timeout=20) == 11
+        second.close()
+        assert log.read() == 'stop\n'
+    finally:
+        first.close()
+        second.close()
+
+
+def test_close_persistent(tmpdir, monkeypatch):
+    """A persistent shared connection is left open."""
+    log = stub_ssh(tmpdir, monkeypatch)
+    tun = make_tunnel(tmpdir, 'example.com')
+    tun.control_persist = 60
+    try:
+        assert tun.call(sum, [1, 2], timeout=20) == 3
+    finally:
+        tun.close()
+    assert log.read() == ''
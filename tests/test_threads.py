@@ -0,0 +1,147 @@
+"""Tests for using tunnels from many threads with a background loop."""
+import time
+from threading import Thread, Lock
+import pytest
+from chopsticks.tunnel import Local, loop
+from chopsticks.group import Group
+from chopsticks.queue import Queue
+
+
+def setup_module():
+    """Run the loop in a background thread."""
+    loop.start_thread()
+
+
+def teardown_module():
+    """Stop the background loop."""
+    loop.stop_thread()
+
+
+def run_threads(func, n=8):
+    """Run func(i) in n threads and return the results in order."""
+    results = [None] * n
+    errors = []
+
+    def target(i):
+        try:
+            results[i] = func(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=target, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    assert not errors
+    return results
+
+
+def test_shared_tunnel():
+    """Many threads can call on a single tunnel at once."""
+    tun = Local('shared')
+    try:
+        start = time.time()
+        results = run_threads(lambda i: tun.call(time.sleep, 0.5) or i)
+        assert results == list(range(8))
+        assert time.time() - start < 4
+    finally:
+        tun.close()
+
+
+def test_tunnel_per_thread():
+    """Threads can each connect and use their own tunnel."""
+    def task(i):
+        with Local('t%d' % i) as tun:
+            return tun.call(str, i)
+    assert run_threads(task) == [str(i) for i in range(8)]
+
+
+def test_group():
+    """Group calls work from other threads."""
+    with Group([Local('g1'), Local('g2')]) as group:
+        results = run_threads(lambda i: dict(group.call(str, i)))
+        for i, res in enumerate(results):
+            assert res == {'g1': str(i), 'g2': str(i)}
+        assert sorted(group.call_iter(str, 'x')) == [
+            ('g1', 'x'), ('g2', 'x')
+        ]
+
+
+def test_submit():
+    """Futures can be waited on from another thread."""
+    tun = Local('futures')
+    try:
+        futures = [tun.submit(str, i) for i in range(20)]
+        assert [f.result() for f in futures] == [str(i) for i in range(20)]
+    finally:
+        tun.close()
+
+
+def test_submit_error():
+    """Errors starting a submitted call are raised from its future."""
+    tun = Local('submit-error')
+    try:
+        f = tun.submit(len, Lock())
+        with pytest.raises(TypeError):
+            f.result(timeout=5)
+        assert tun.call(str, 1) == '1'
+    finally:
+        tun.close()
+
+
+def test_call_iter_error():
+    """Errors starting a group operation are raised in the caller."""
+    with Group([Local('ie1'), Local('ie2')]) as group:
+        with pytest.raises(TypeError):
+            list(group.call_iter(len, Lock()))
+
+
+def test_callback_error():
+    """A failing done callback does not stop the loop."""
+    tun = Local('callback-error')
+    try:
+        f = tun.submit(str, 'x')
+        f.add_done_callback(lambda f: 1 / 0)
+        results = run_threads(lambda i: tun.call(str, i), n=2)
+        assert results == ['0', '1']
+        assert f.result(timeout=5) == 'x'
+    finally:
+        tun.close()
+
+
+def test_loop_thread_stopped():
+    """Threads waiting on the loop notice if its thread stops."""
+    tun = Local('stopped')
+    tun.connect()
+    errors = []
+
+    def target():
+        try:
+            tun.call(time.sleep, 1)
+        except RuntimeError as e:
+            errors.append(e)
+
+    t = Thread(target=target)
+    t.start()
+    time.sleep(0.2)
+    loop.stop_thread()
+    t.join(5)
+    loop.start_thread()
+    try:
+        assert not t.is_alive()
+        assert len(errors) == 1
+    finally:
+        tun.close()
+
+
+def test_queue():
+    """A queue can be run while the loop is in a background thread."""
+    tun = Local('queued')
+    try:
+        queue = Queue()
+        res = queue.call(tun, str, 'q')
+        queue.run()
+        assert res.value == 'q'
+    finally:
+        tun.close()
@@ -0,0 +1,49 @@
+"""Tests for operation timeouts."""
+import time
+import pytest
+from chopsticks.tunnel import Local, RemoteException, ErrorResult
+from chopsticks.group import Group
+from chopsticks.queue import Queue
+from helpers import sleep_on
+
+
+def test_call_timeout():
+    """A call that takes too long raises RemoteException."""
+    with Local('slow') as tun:
+        start = time.time()
+        with pytest.raises(RemoteException):
+            tun.call(sleep_on, 'slow', 2, 'late', timeout=0.2)
+        assert time.time() - start < 1
+
+
+def test_late_response_discarded():
+    """The tunnel remains usable after a timeout."""
+    with Local('slow') as tun:
+        # Warm up, so that remote imports do not count against the timeout
+        tun.call(sleep_on, 'slow', 0, None)
+        with pytest.raises(RemoteException):
+            tun.call(sleep_on, 'slow', 0.5, 'late', timeout=0.1)
+        time.sleep(0.5)
+        assert tun.call(sleep_on, 'slow', 0, 'ok') == 'ok'
+
+
+def test_group_stragglers():
+    """Hosts that miss the deadline of a Group.call() get ErrorResults."""
+    grp = Group([Local('fast'), Local('slow')])
+    with grp:
+        # Warm up, so that remote imports do not count against the timeout
+        grp.call(sleep_on, 'slow', 0, None)
+        start = time.time()
+        res = grp.call(sleep_on, 'slow', 2, 'done', timeout=0.5)
+        assert time.time() - start < 1.5
+    assert res['fast'] == 'done'
+    assert isinstance(res['slow'], ErrorResult)
+
+
+def test_queue_timeout():
+    """Queued calls accept a timeout."""
+    with Local('slow') as tun:
+        q = Queue()
+        res = q.call(tun, sleep_on, 'slow', 2, 'late', timeout=0.2)
+        q.run()
+        assert isinstance(res.value, ErrorResult)
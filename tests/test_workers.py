@@ -0,0 +1,56 @@
+"""Tests for the pool of worker threads on the remote host."""
+import sys
+import time
+from chopsticks.tunnel import Local, gather
+from helpers import sleep_on
+
+
+def test_bounded():
+    """At most `workers` calls run at once; the rest are queued."""
+    tun = Local('pool')
+    tun.workers = 2
+    try:
+        tun.connect()
+        start = time.time()
+        futures = [tun.submit(time.sleep, 0.3) for _ in range(4)]
+        gather(futures)
+        assert time.time() - start >= 0.6
+        assert tun.queued_ops == 2
+        assert tun.queued_time >= 0.5
+    finally:
+        tun.close()
+
+
+def test_not_saturated():
+    """Calls that find a free worker are not counted as queued."""
+    with Local('pool') as tun:
+        assert tun.call(time.sleep, 0) is None
+        assert tun.queued_ops == 0
+
+
+def test_imports_with_one_worker():
+    """A worker can import modules while other calls are queued."""
+    tun = Local('pool')
+    tun.workers = 1
+    try:
+        futures = [tun.submit(sleep_on, 'pool', 0, i) for i in range(5)]
+        assert gather(futures) == list(range(5))
+    finally:
+        tun.close()
+
+
+def remote_queue_depth():
+    """Get the depth of the remote host's output queue."""
+    return sys.modules['__bubble__'].outqueue.maxsize
+
+
+def test_queue_depth():
+    """The remote output queue depth is set from the tunnel."""
+    tun = Local('pool')
+    tun.queue_depth = 5
+    try:
+        assert tun.call(remote_queue_depth) == 5
+        futures = [tun.submit(str, i) for i in range(100)]
+        assert gather(futures) == [str(i) for i in range(100)]
+    finally:
+        tun.close()